@@ -1,14 +1,27 @@
-import asyncio
+import contextlib
+import itertools
 import logging
 import math
 import time
+import zlib
 from typing import Optional, Dict, List, Tuple
 
-import nest_asyncio
+import numpy as np
 from palaestrai.agent import Muscle, SensorInformation, ActuatorInformation
 
+from .winzent_allocation import allocate_leftover_flexibility
+from .winzent_ethics import EthicsScoreModel
+from .winzent_event_loop import EventLoopThread
 from .winzent_mas import WinzentMAS
-from .winzent_util import WinzentSensorActuatorUtil
+from .winzent_negotiation import (
+    FlexibilityLedger,
+    LatencySketch,
+    NegotiationTracker,
+    RestartScheduler,
+    split_result,
+)
+from .winzent_recorder import EthicsScoreRecorder
+from .winzent_util import SensorActuatorIndex, WinzentSensorActuatorUtil
 from mango_library.negotiation.winzent.winzent_base_agent import WinzentBaseAgent
 
 logger = logging.getLogger(__name__)
@@ -25,21 +38,63 @@ class WinzentMuscle(Muscle):
         self.number_of_restartable_negotiations = params.get(
             "number_of_restartable_negotiations", 40
         )
+        # further restrictions of the restarts (None: only the global number applies)
+        self.restarts_per_agent = params.get("restarts_per_agent", None)
+        # {ethics score tier: number of restarts}
+        self.restarts_per_tier = params.get("restarts_per_tier", None)
+        self.max_concurrent_restarts = params.get("max_concurrent_restarts", None)
+        # negotiate the merged demand of all loads of a bus by the bus agent
+        self.aggregate_loads_by_bus = params.get("aggregate_loads_by_bus", False)
+        # how the result of a bus is split to its loads: "proportional" or "ethics_score"
+        self.bus_demand_split = params.get("bus_demand_split", "proportional")
+        # allocate the leftover flexibility centrally to loads whose negotiation timed out
+        self.fallback_allocation = params.get("fallback_allocation", False)
+        # start from the allocation of the previous step and only negotiate the differences
+        self.incremental_negotiation = params.get("incremental_negotiation", False)
         self.ethics_score_config = params.get("ethics_score_config", None)
         self.send_message_paths = params.get("send_message_paths", True)
         self.request_processing_waiting_time = float(params.get("request_processing_waiting_time", 0.4))
         self.reply_processing_waiting_time = params.get("reply_processing_waiting_time", 0.4)
         self.use_ethics_score_as_contributor = params.get("use_producer_ethics_score", True)
         self.use_ethics_score_as_negotiator = params.get("use_consumer_ethics_score", True)
+        # negotiate inside transformer-fed areas first, then escalate residual demand
+        self.hierarchical_negotiation = params.get("hierarchical_negotiation", False)
+        # path of a compiled topology (see winzent_artifact.compile_topology)
+        self.topology_artifact = params.get("topology_artifact", None)
+        # keep the agents alive at the end of an episode and reset them instead
+        self.reuse_mas_across_episodes = params.get("reuse_mas_across_episodes", False)
+        # wall-clock limit for all negotiations of a step (default: three negotiation rounds)
+        self.step_timeout = params.get("step_timeout", self.time_to_sleep * 3 * 3)
+        # derive the timeout of every agent from the latencies of its past negotiations
+        self.adaptive_timeouts = params.get("adaptive_timeouts", False)
+        self.timeout_quantile = params.get("timeout_quantile", 0.99)
+        # relative margin added to the latency quantile
+        self.timeout_margin = params.get("timeout_margin", 0.5)
+        self.min_latency_samples = params.get("min_latency_samples", 10)
+        # lower bound for shortening the time_to_sleep of fast agents (None: never shorten)
+        self.min_time_to_sleep = params.get("min_time_to_sleep", None)
+        # directory the ethics scores of every episode are saved to (None: not saved)
+        self.ethics_score_record_path = params.get("ethics_score_record_path", None)
+        # log one summary record per step instead of the per-agent details and prints
+        self.performance_logging = params.get("performance_logging", False)
+        # share of the agents whose details are logged in performance logging mode
+        self.agent_log_sample_rate = params.get("agent_log_sample_rate", 0.0)
 
         self.decay_rate = 0
         self.sub_tier_size = 0
+        self.ethics_score_model: Optional[EthicsScoreModel] = None
         self.ethics_score_list = {}
+        # (agent, success, deficit) of the final negotiations of the step, applied at its end
+        self.negotiation_outcomes: List[Tuple[WinzentBaseAgent, bool, int]] = []
+        self.ethics_score_recorder = EthicsScoreRecorder(self.end / self.step_size)
+        self.episode = 0
         self.calc_ethics_score_params()
 
         self.initialized = False
         self.time = self.step_size
         self.winzent_mas: Optional[WinzentMAS] = None
+        # the agents live on this loop across all steps
+        self.event_loop = EventLoopThread()
         # mapping: sensor list to (type, agent)
         self.sensor_mapping: List[
             Tuple[str, Optional[WinzentBaseAgent]]
@@ -48,19 +103,40 @@ class WinzentMuscle(Muscle):
         self.actuator_mapping: List[
             Tuple[str, Optional[WinzentBaseAgent]]
         ] = []
+        # positions of the sensors and actuators used in every step
+        self.sensor_index: Optional[SensorActuatorIndex] = None
+        # values of (sgen flexibility, load p_mw, all load sensors) in the current step
+        self.sensor_values: Tuple[np.ndarray, np.ndarray, np.ndarray] = (
+            np.zeros(0), np.zeros(0), np.zeros(0)
+        )
 
         # To get solution to the actuators
         self.initial_generator_values: Dict[str:int] = {}
         self.initial_grid_json = None
         self.rounded_load_values: Dict[str:int] = {}
         self.final_solution = {}
+        # hierarchical negotiation: flexibility of the sgens left after the area negotiations
+        self.remaining_flexibility: Dict[str:int] = {}
+        # aggregated negotiations: aid of the negotiating bus -> its loads
+        self.bus_demand_groups: Dict[str, List[WinzentBaseAgent]] = {}
+        # negotiations that timed out in this step and wait for the fallback allocation
+        self.timed_out_agents: List[WinzentBaseAgent] = []
+        # incremental negotiation: load aid -> {sgen aid: value} of the previous step
+        self.previous_allocation: Dict[str, Dict[str, int]] = {}
+        # aid -> latencies of the negotiations of the agent
+        self.negotiation_latencies: Dict[str, LatencySketch] = {}
 
         self.messages_sent_in_step = 0
+        # performance logging: values of the current step logged in one record
+        self.step_summary = {}
+        # runtimes of the phases and counters of the current step (info dict of propose_actions)
+        self.step_statistics: Dict[str, float] = {}
 
     def calc_ethics_score_params(self):
         total_amount_of_steps = self.end / self.step_size
         self.sub_tier_size = 1.0 / total_amount_of_steps
         self.decay_rate = self.sub_tier_size / total_amount_of_steps
+        self.ethics_score_model = EthicsScoreModel(self.sub_tier_size, self.decay_rate)
         self.reset_ethics_score_list()
 
     def reset_ethics_score_list(self):
@@ -106,121 +182,452 @@ class WinzentMuscle(Muscle):
             )
             self.actuator_mapping.append((actuator_type, agent))
 
+        self.sensor_index = SensorActuatorIndex(
+            self.sensor_mapping,
+            self.actuator_mapping,
+            [sensor.sensor_id for sensor in sensors],
+        )
+
     def update_flexibilities(self, sensors):
         # example sensor_id: env.Powergrid-0.0-load-0-15.p_mw
         # example sensor_id: env.Powergrid-0.0-load-0-15.q_mvar
 
-        for sensor, (sensor_type, agent) in zip(sensors, self.sensor_mapping):
-            if agent is not None:
-                if agent.elem_type == "sgen" and sensor_type == "p_mw_flex":
-                    flexibility = sensor.sensor_value * self.factor_mw
-                    self.initial_generator_values[agent.aid] = flexibility
-                    agent.update_flexibility(
-                        t_start=self.time,
-                        min_p=0,
-                        max_p=math.floor(flexibility),
-                    )
-                elif agent.elem_type == "load" and sensor_type == "p_mw":
-                    # print(f"{agent.aid}: {sensor.sensor_value}")
-                    self.rounded_load_values[agent.aid] = math.ceil(
-                        sensor.sensor_value * self.factor_mw
-                    )
-                    agent.update_flexibility(
-                        t_start=self.time, min_p=0, max_p=0
-                    )
+        self.sensor_values = self.sensor_index.gather(sensors)
+        sgen_flex, load_p_mw, _ = self.sensor_values
+        flexibilities = sgen_flex * self.factor_mw
+        for agent, flexibility, max_p in zip(
+                self.sensor_index.sgen_flex_agents,
+                flexibilities.tolist(),
+                np.floor(flexibilities).astype(np.int64).tolist(),
+        ):
+            self.initial_generator_values[agent.aid] = flexibility
+            agent.update_flexibility(t_start=self.time, min_p=0, max_p=max_p)
+        for agent, rounded_load_value in zip(
+                self.sensor_index.load_agents,
+                np.ceil(load_p_mw * self.factor_mw).astype(np.int64).tolist(),
+        ):
+            self.rounded_load_values[agent.aid] = rounded_load_value
+            agent.update_flexibility(t_start=self.time, min_p=0, max_p=0)
 
-        logger.debug(
-            f"initial generator values: {self.initial_generator_values}"
-        )
+        logger.debug("initial generator values: %s", self.initial_generator_values)
 
     async def run_negotiations(self, sensors):
         self.messages_sent_in_step = 0
-        agents_with_started_negotiation = []
+        negotiations = NegotiationTracker(self.step_timeout)
         time_span = [self.time]
         # start a negotiation for every load with the new value
-        for sensor, (sensor_type, agent) in zip(sensors, self.sensor_mapping):
-            if sensor_type == "p_mw" and agent is not None:
-                if agent.elem_type == "load":
-                    if sensor.sensor_value > 0:
-                        # only start negotiation if value is larger than 0
-                        logger.debug(
-                            f"Start negotiation for {agent.aid} with value {math.ceil(sensor.sensor_value * self.factor_mw)}"
-                        )
-                        await agent.start_negotiation(
-                            start_dates=time_span,
-                            values=[math.ceil(
-                                sensor.sensor_value * self.factor_mw
-                            )],
-                        )
-                        agents_with_started_negotiation.append(agent)
+        negotiating_agents = self.get_negotiating_agents(sensors)
+        with self.measure("initial_negotiation_starts"):
+            for agent in negotiating_agents:
+                # the result is only non-empty with an allocation carried over from the last step
+                value = self.rounded_load_values[agent.aid] - sum(agent.result.values())
+                if value <= 0:
+                    self.score_negotiation(agent, True)
+                    continue
+                if self.is_agent_logged(agent):
+                    logger.debug("Start negotiation for %s with value %s", agent.aid, value)
+                self.adapt_time_to_sleep(agent)
+                await agent.start_negotiation(
+                    start_dates=time_span,
+                    values=[value],
+                )
+                negotiations.add(agent, timeout=self.negotiation_timeout(agent))
+        self.count("negotiations", len(negotiations))
+
+        if self.hierarchical_negotiation:
+            await self.run_area_negotiations(negotiations, time_span)
 
-        number_of_restarted_negotiations = (
-            self.number_of_restartable_negotiations
-        )  # restriction of restarted negotiations
+        # flexibility committed to the negotiating agents per connected component
+        ledger = FlexibilityLedger(
+            {aid: math.floor(value) for aid, value in self.initial_generator_values.items()},
+            component_of=self.winzent_mas.graph.component_of,
+        )
+        for agent in itertools.chain(
+                self.winzent_mas.winzent_agents["load"].values(),
+                self.winzent_mas.winzent_agents["bus"].values(),
+        ):
+            ledger.update(agent)
+        restarts = RestartScheduler(
+            total_budget=self.number_of_restartable_negotiations,
+            per_agent_budget=self.restarts_per_agent,
+            per_tier_budget=self.restarts_per_tier,
+            max_concurrent=self.max_concurrent_restarts,
+        )
 
         logger.debug(
             "All initial negotiations started; waiting for negotiations to be done and restarting "
             "unsuccessful negotiations"
         )
-        # waiting for all negotiations to finish
-        while len(agents_with_started_negotiation) > 0:
-            agent = agents_with_started_negotiation.pop(0)
-            try:
-                await asyncio.wait_for(agent.negotiation_done, timeout=agent.time_to_sleep * 3)
-                logger.debug(f"{agent.aid} negotiation done")
-                # restart unsuccessful negotiations
-                # only allow a restricted number of restarts
+        # handle every negotiation as soon as it is done
+        while len(negotiations) > 0 or len(restarts) > 0:
+            if len(negotiations) > 0:
+                finished_agents, timed_out_agents = await self.wait_for_negotiations(negotiations)
+            else:
+                finished_agents, timed_out_agents = [], []
+            for agent in timed_out_agents:
+                restarts.finished(agent)
+                self.handle_timed_out_negotiation(agent)
+            for agent in finished_agents:
+                if self.is_agent_logged(agent):
+                    logger.debug("%s negotiation done", agent.aid)
+                ledger.update(agent)
                 agent_result_sum = 0
                 for num in agent.result.values():
                     agent_result_sum += num
                 # check if negotiation fulfills requirements
                 negotiation_successful = agent_result_sum >= self.rounded_load_values[agent.aid]
-                if not negotiation_successful:
-                    if number_of_restarted_negotiations > 0:
-                        # get sum of already negotiated values for this agent
-                        # negotiation was not fully successful, therefore restart
-                        agents_with_started_negotiation.append(agent)
-                        # restart the negotiation with the missing value
-                        await agent.start_negotiation(
-                            start_dates=time_span,
-                            values=[self.rounded_load_values[agent.aid]
-                                    - agent_result_sum],
-                        )
-                        logger.debug(
-                            f"{agent.aid} restarted negotiation for value "
-                            f"of {self.rounded_load_values[agent.aid] - agent_result_sum}"
-                        )
-                        number_of_restarted_negotiations -= 1
-                    elif agent_result_sum > self.rounded_load_values[agent.aid]:
-                        logger.error(
-                            f"Too much power: {agent.aid} has with a sum of {agent_result_sum} instead of "
-                            f"{self.rounded_load_values[agent.aid]} from the result:{agent.result} "
-                            f"not a feasible solution"
-                        )
-                    else:
-                        agent.ethics_score = self.calculate_new_ethics_score(negotiation_successful, agent.ethics_score)
-                        self.save_ethics_score_development(self.ethics_score_list, agent, negotiation_successful)
-                else:
-                    agent.ethics_score = self.calculate_new_ethics_score(negotiation_successful, agent.ethics_score)
-                    self.save_ethics_score_development(self.ethics_score_list, agent, negotiation_successful)
-            except asyncio.TimeoutError:
-                logger.error(
-                    f"{agent.aid} could not finish its negotiation in time. No restart permission can be given.")
-                agent.ethics_score = self.calculate_new_ethics_score(False, agent.ethics_score)
-                self.save_ethics_score_development(self.ethics_score_list, agent, False)
-        logger.info(f"ethics_scores -->{self.ethics_score_list}")
+                if negotiation_successful:
+                    restarts.finished(agent)
+                elif ledger.unallocated(agent) <= 0:
+                    # no flexibility left that could cover the deficit
+                    restarts.finished(agent)
+                    self.record_outage(agent, self.rounded_load_values[agent.aid] - agent_result_sum)
+                    continue
+                elif restarts.request(agent, self.rounded_load_values[agent.aid] - agent_result_sum):
+                    # negotiation was not fully successful, restart it with the missing value
+                    # as soon as the scheduler grants it
+                    continue
+                self.score_negotiation(agent, negotiation_successful)
+
+            if negotiations.expired:
+                # no time left to restart the remaining negotiations
+                for agent in restarts.drain():
+                    self.score_negotiation(agent, False)
+                continue
+            granted_restarts, dropped_agents = restarts.next_restarts(
+                feasible=lambda agent, deficit: ledger.unallocated(agent) > 0
+            )
+            for agent in dropped_agents:
+                self.record_outage(
+                    agent, self.rounded_load_values[agent.aid] - sum(agent.result.values())
+                )
+            with self.measure("restarts"):
+                for agent, deficit in granted_restarts:
+                    self.adapt_time_to_sleep(agent)
+                    await agent.start_negotiation(start_dates=time_span, values=[deficit])
+                    negotiations.add(agent, timeout=self.negotiation_timeout(agent))
+                    if self.is_agent_logged(agent):
+                        logger.debug("%s restarted negotiation for value of %s", agent.aid, deficit)
+            self.count("restarts", len(granted_restarts))
+        if self.timed_out_agents:
+            with self.measure("fallback_allocation"):
+                self.allocate_fallback()
+        self.count("restarts_not_granted", restarts.skipped)
+        if restarts.skipped > 0:
+            logger.debug("%s restarts were not granted", restarts.skipped)
+        logger.debug("flexibility committed: %s of %s", ledger.committed, ledger.available)
+        with self.measure("ethics_scores"):
+            self.apply_ethics_scores()
+        if self.performance_logging:
+            self.step_summary["ethics_scores"] = {
+                tier: list(values) for tier, values in self.ethics_score_list.items()
+            }
+        else:
+            logger.info("ethics_scores -->%s", self.ethics_score_list)
         self.reset_ethics_score_list()
 
-    def save_negotiated_solution_by_load(self):
-        self.final_solution = {}
-        for agent in self.winzent_mas.winzent_agents["load"].values():
-            logger.debug(f"muscle: LOAD {agent.aid} result:{agent.result}")
+    def get_negotiating_agents(self, sensors) -> List[WinzentBaseAgent]:
+        """
+        returns the agents that negotiate the demand of the loads in this step: the loads
+        with a value larger than 0 or, if loads are aggregated by bus, the bus agent for
+        every bus with more than one of these loads
+        """
+        _, load_p_mw, _ = self.sensor_values
+        loads = [
+            self.sensor_index.load_agents[position]
+            for position in np.flatnonzero(load_p_mw > 0).tolist()
+        ]
+        self.bus_demand_groups = {}
+        if not self.aggregate_loads_by_bus:
+            return loads
+        loads_of_bus: Dict[WinzentBaseAgent, List[WinzentBaseAgent]] = {}
+        for agent in loads:
+            bus_agent = self.winzent_mas.get_bus_agent_of(agent)
+            loads_of_bus.setdefault(bus_agent, []).append(agent)
+        negotiating_agents = []
+        for bus_agent, bus_loads in loads_of_bus.items():
+            if bus_agent is None or len(bus_loads) == 1:
+                negotiating_agents.extend(bus_loads)
+                continue
+            self.bus_demand_groups[bus_agent.aid] = bus_loads
+            # carried over allocations of the loads are part of the result of the bus
+            for agent in bus_loads:
+                for sgen, value in agent.result.items():
+                    bus_agent.result[sgen] = bus_agent.result.get(sgen, 0) + value
+                agent.result = {}
+            self.rounded_load_values[bus_agent.aid] = sum(
+                self.rounded_load_values[agent.aid] for agent in bus_loads
+            )
+            # the bus negotiates with the priority of its most important load
+            bus_agent.ethics_score = max(agent.ethics_score for agent in bus_loads)
+            bus_agent.update_flexibility(t_start=self.time, min_p=0, max_p=0)
+            negotiating_agents.append(bus_agent)
+        logger.debug("%s loads negotiate with %s negotiations", len(loads), len(negotiating_agents))
+        return negotiating_agents
+
+    def carry_over_allocations(self):
+        """
+        incremental negotiation: gives every load the part of its allocation of the last
+        step that is still feasible (sgen reachable, enough flexibility, not more than the
+        new demand) and removes it from the flexibility the sgens offer in the negotiations
+        """
+        graph = self.winzent_mas.graph
+        free_flexibility = {
+            aid: math.floor(flexibility) for aid, flexibility in self.initial_generator_values.items()
+        }
+        loads = [
+            self.winzent_mas.aid_agent_mapping[aid] for aid in self.previous_allocation
+            if self.rounded_load_values.get(aid, 0) > 0
+        ]
+        carried = 0
+        # loads with higher ethics scores keep their allocation first
+        for agent in sorted(loads, key=lambda load: load.ethics_score, reverse=True):
+            demand = self.rounded_load_values[agent.aid]
+            component = graph.component_of(agent.aid)
+            for sgen, value in self.previous_allocation[agent.aid].items():
+                if sgen not in free_flexibility or graph.component_of(sgen) != component:
+                    continue
+                value = min(value, free_flexibility[sgen], demand)
+                if value <= 0:
+                    continue
+                agent.result[sgen] = value
+                free_flexibility[sgen] -= value
+                demand -= value
+                carried += value
+        self.previous_allocation = {}
+        for aid, flexibility in free_flexibility.items():
+            if flexibility < math.floor(self.initial_generator_values[aid]):
+                self.winzent_mas.aid_agent_mapping[aid].update_flexibility(
+                    t_start=self.time, min_p=0, max_p=flexibility
+                )
+        logger.debug("%s carried over from the allocation of the last step", carried)
+
+    def score_negotiation(self, agent, success):
+        """records the outcome of the final negotiation of the agent in this step"""
+        if agent.aid not in self.bus_demand_groups:
+            self.negotiation_outcomes.append(
+                (agent, success, max(self.rounded_load_values[agent.aid] - sum(agent.result.values()), 0))
+            )
+            return
+        # the result of a bus belongs to its loads
+        loads = self.bus_demand_groups[agent.aid]
+        load_results = split_result(
+            agent.result,
+            [self.rounded_load_values[load.aid] for load in loads],
+            rule=self.bus_demand_split,
+            priorities=[load.ethics_score for load in loads],
+        )
+        agent.result = {}
+        for load, load_result in zip(loads, load_results):
+            load.result = load_result
+            self.score_negotiation(
+                load, sum(load_result.values()) >= self.rounded_load_values[load.aid]
+            )
+
+    def record_outage(self, agent, deficit):
+        """the deficit of the agent can not be covered in this step"""
+        if self.is_agent_logged(agent):
+            logger.info(
+                "%s: no flexibility left for the missing %s, negotiation is not restarted",
+                agent.aid, deficit,
+            )
+        self.score_negotiation(agent, False)
+
+    async def wait_for_negotiations(self, negotiations):
+        """waits for the next finished or timed out negotiations and records their latencies"""
+        with self.measure("waiting"):
+            finished_agents, timed_out_agents = await negotiations.wait()
+        self.count("timeouts", len(timed_out_agents))
+        if self.adaptive_timeouts:
+            for agent in finished_agents + timed_out_agents:
+                if agent.aid not in self.negotiation_latencies:
+                    self.negotiation_latencies[agent.aid] = LatencySketch()
+                self.negotiation_latencies[agent.aid].add(negotiations.latencies[agent.aid])
+        return finished_agents, timed_out_agents
+
+    def observed_latency(self, agent):
+        """
+        returns the latency quantile of the agent's negotiations plus the margin, or None
+        without adaptive timeouts or enough observed negotiations
+        """
+        latencies = self.negotiation_latencies.get(agent.aid)
+        if (
+                not self.adaptive_timeouts
+                or latencies is None
+                or latencies.count < self.min_latency_samples
+        ):
+            return None
+        return latencies.quantile(self.timeout_quantile) * (1 + self.timeout_margin)
+
+    def adapt_time_to_sleep(self, agent):
+        """shortens the time_to_sleep of fast agents, called before a negotiation is started"""
+        latency = self.observed_latency(agent)
+        if latency is not None and self.min_time_to_sleep is not None:
+            agent.time_to_sleep = min(max(latency, self.min_time_to_sleep), self.time_to_sleep)
+
+    def negotiation_timeout(self, agent):
+        """
+        returns how long to wait for the negotiation of the agent. With adaptive timeouts
+        and enough observed negotiations this is the latency quantile plus the margin,
+        otherwise three times the time_to_sleep.
+        """
+        latency = self.observed_latency(agent)
+        if latency is None:
+            return agent.time_to_sleep * 3
+        # an agent waits time_to_sleep for replies, the deadline of the step bounds the timeout
+        return max(latency, agent.time_to_sleep)
+
+    def apply_ethics_scores(self):
+        """updates the ethics scores of all agents with a final negotiation in this step at once"""
+        if not self.negotiation_outcomes:
+            return
+        agents, successes, deficits = zip(*self.negotiation_outcomes)
+        self.negotiation_outcomes = []
+        ethics_scores = self.ethics_score_model.update(
+            [agent.ethics_score for agent in agents], successes
+        )
+        self.ethics_score_recorder.record(
+            self.time, [agent.aid for agent in agents], ethics_scores, successes, deficits
+        )
+        for agent, ethics_score, success in zip(agents, ethics_scores.tolist(), successes):
+            agent.ethics_score = ethics_score
+            self.save_ethics_score_development(self.ethics_score_list, agent, success)
+
+    def handle_timed_out_negotiation(self, agent):
+        logger.error(
+            "%s could not finish its negotiation in time. No restart permission can be given.", agent.aid
+        )
+        if self.fallback_allocation:
+            self.timed_out_agents.append(agent)
+        else:
+            self.score_negotiation(agent, False)
+
+    def allocate_fallback(self):
+        """
+        covers the deficits of the timed out negotiations with the flexibility that is
+        left after all negotiations of the step (see allocate_leftover_flexibility)
+        """
+        start_time = time.time()
+        agents = self.timed_out_agents
+        self.timed_out_agents = []
+        solution = self.get_negotiated_solution()
+        sgen_aids = list(self.initial_generator_values.keys())
+        graph = self.winzent_mas.graph
+
+        def component(aid):
+            component_of_agent = graph.component_of(aid)
+            return -1 if component_of_agent is None else component_of_agent
+
+        load_positions, sgen_positions, values = allocate_leftover_flexibility(
+            demands=np.array(
+                [self.rounded_load_values[agent.aid] - sum(agent.result.values()) for agent in agents]
+            ),
+            priorities=np.array([agent.ethics_score for agent in agents]),
+            demand_components=np.array([component(agent.aid) for agent in agents]),
+            supplies=np.array(
+                [math.floor(self.initial_generator_values[aid]) - solution.get(aid, 0) for aid in sgen_aids]
+            ),
+            supply_components=np.array([component(aid) for aid in sgen_aids]),
+        )
+        for load_position, sgen_position, value in zip(
+                load_positions.tolist(), sgen_positions.tolist(), values.tolist()
+        ):
+            result = agents[load_position].result
+            result[sgen_aids[sgen_position]] = result.get(sgen_aids[sgen_position], 0) + value
+        logger.debug(
+            "fallback allocation of %s for %s timed out negotiations took %s",
+            int(values.sum()), len(agents), time.time() - start_time,
+        )
+        for agent in agents:
+            self.score_negotiation(
+                agent, sum(agent.result.values()) >= self.rounded_load_values[agent.aid]
+            )
+
+    async def run_area_negotiations(self, negotiations, time_span):
+        """
+        waits for the negotiations inside the areas, hands the remaining flexibility to the
+        area aggregators and restarts the negotiations of the loads with remaining demand
+        across the areas, which are added to the tracked negotiations again
+        """
+        agents_with_remaining_demand = []
+        while len(negotiations) > 0:
+            finished_agents, timed_out_agents = await self.wait_for_negotiations(negotiations)
+            for agent in timed_out_agents:
+                self.handle_timed_out_negotiation(agent)
+            for agent in finished_agents:
+                if sum(agent.result.values()) < self.rounded_load_values[agent.aid]:
+                    agents_with_remaining_demand.append(agent)
+                else:
+                    self.score_negotiation(agent, True)
+
+        self.remaining_flexibility = self.get_remaining_flexibility()
+        self.winzent_mas.escalate_to_areas(self.time, self.remaining_flexibility)
+        logger.debug(
+            "%s loads escalate their remaining demand to the areas", len(agents_with_remaining_demand)
+        )
+        with self.measure("area_negotiation_starts"):
+            for agent in agents_with_remaining_demand:
+                self.adapt_time_to_sleep(agent)
+                await agent.start_negotiation(
+                    start_dates=time_span,
+                    values=[self.rounded_load_values[agent.aid] - sum(agent.result.values())],
+                )
+                negotiations.add(agent, timeout=self.negotiation_timeout(agent))
+        self.count("area_negotiations", len(agents_with_remaining_demand))
+
+    def get_remaining_flexibility(self):
+        """returns the flexibility of every sgen that has not been negotiated yet in this step"""
+        allocated = {}
+        # buses only have results if they negotiate for their loads
+        for agent in itertools.chain(
+                self.winzent_mas.winzent_agents["load"].values(),
+                self.winzent_mas.winzent_agents["bus"].values(),
+        ):
+            for sgen, value in agent.result.items():
+                allocated[sgen] = allocated.get(sgen, 0) + value
+        return {
+            aid: math.floor(flexibility) - allocated.get(aid, 0)
+            for aid, flexibility in self.initial_generator_values.items()
+        }
+
+    def get_negotiated_solution(self):
+        """returns the values negotiated so far in this step per sgen"""
+        solution = {}
+        for agent in itertools.chain(
+                self.winzent_mas.winzent_agents["load"].values(),
+                self.winzent_mas.winzent_agents["bus"].values(),
+        ):
             for sgen in agent.result.keys():
-                if sgen not in self.final_solution.keys():
-                    self.final_solution[sgen] = 0
-                self.final_solution[sgen] += agent.result[sgen]
+                if sgen not in solution.keys():
+                    solution[sgen] = 0
+                solution[sgen] += agent.result[sgen]
+        if self.winzent_mas.area_links_open:
+            # values negotiated with aggregators belong to the sgens of their areas
+            solution = self.winzent_mas.distribute_area_results(
+                solution, self.remaining_flexibility
+            )
+        return solution
+
+    def save_negotiated_solution_by_load(self):
+        if logger.isEnabledFor(logging.DEBUG):
+            for agent in self.winzent_mas.winzent_agents["load"].values():
+                if self.is_agent_logged(agent):
+                    logger.debug("muscle: LOAD %s result:%s", agent.aid, agent.result)
+        self.final_solution = self.get_negotiated_solution()
+        if self.incremental_negotiation:
+            self.previous_allocation = {
+                agent.aid: dict(agent.result)
+                for agent in self.winzent_mas.winzent_agents["load"].values()
+                if agent.result
+            }
+        for agent in itertools.chain(
+                self.winzent_mas.winzent_agents["load"].values(),
+                self.winzent_mas.winzent_agents["bus"].values(),
+        ):
             # reset result for next step
             agent.result = {}
+        if self.winzent_mas.area_links_open:
+            self.winzent_mas.close_area_links()
 
     def save_number_of_sent_msg(self):
         """
@@ -235,64 +642,84 @@ class WinzentMuscle(Muscle):
     def set_actuator_setpoints(self, actuators_available):
         # after negotiation fetch the results and give them to the actuators
         # for later winzent versions
-        logger.debug("final solution of what winzent has negotiated")
-        logger.debug(self.final_solution)
-        logger.info(f"agent types: {self.winzent_mas.agent_types}")
-        for actuator, (actuator_type, agent) in zip(
-                actuators_available, self.actuator_mapping
+        logger.debug("final solution of what winzent has negotiated: %s", self.final_solution)
+        if not self.performance_logging:
+            logger.info("agent types: %s", self.winzent_mas.agent_types)
+        agents = self.sensor_index.scaling_agents
+        has_solution = np.array(
+            [agent.aid in self.final_solution for agent in agents], dtype=bool
+        )
+        negotiated = np.array(
+            [self.final_solution.get(agent.aid, 0) for agent in agents], dtype=np.float64
+        )
+        initial = np.array(
+            [self.initial_generator_values.get(agent.aid, 0) for agent in agents], dtype=np.float64
+        )
+        has_solution &= initial > 0
+        values = np.divide(negotiated, initial, out=np.zeros_like(negotiated), where=has_solution)
+        for position in np.flatnonzero(values > 1).tolist():
+            logger.info(
+                "final solution: %s and initial generator values %s; actuator value = %s",
+                negotiated[position], initial[position], values[position],
+            )
+            logger.info(
+                "WARNING: Invalid Winzent result detected."
+                "Winzent negotiation results are altered to"
+                "avoid the experiment from crashing."
+            )
+        values = np.minimum(values, 1)
+        # agent type -> {"produced": total value, "setpoints": {aid: setpoint}}
+        produced = {}
+        for position, agent, solved, value in zip(
+                self.sensor_index.scaling_positions.tolist(), agents, has_solution.tolist(), values.tolist()
         ):
-            if actuator_type == "scaling" and agent is not None:
-                logger.debug(self.final_solution)
-                if (
-                        agent.aid in self.final_solution
-                        and self.initial_generator_values[agent.aid] > 0
-                ):
-
-                    value = (
-                            self.final_solution[agent.aid]
-                            / self.initial_generator_values[agent.aid]
-                    )
-                    logger.debug(
-                        f"final solution: {self.final_solution[agent.aid]} and initial generator values {self.initial_generator_values[agent.aid]}; actuator value = {value}"
-                    )
-                    if value > 1:
-                        logger.info(
-                            f"final solution: {self.final_solution[agent.aid]} and initial generator values {self.initial_generator_values[agent.aid]}; actuator value = {value}")
-                        value = 1
-                        logger.info(
-                            "WARNING: Invalid Winzent result detected."
-                            "Winzent negotiation results are altered to"
-                            "avoid the experiment from crashing."
-                        )
-                    actuator(value)
-                    for key, value_list in self.winzent_mas.agent_types.items():
-                        if agent.aid in value_list:
-                            print(f"PRODUCED {self.final_solution[agent.aid]} {key} {value} {agent.aid}")
-                else:
-                    logger.debug("actuator set to zero")
-                    actuator(0)
+            actuator = actuators_available[position]
+            if solved:
+                actuator(value)
+                agent_type = self.winzent_mas.agent_type_of.get(agent.aid)
+                if agent_type is not None:
+                    if agent_type not in produced:
+                        produced[agent_type] = {"produced": 0, "setpoints": {}}
+                    produced[agent_type]["produced"] += self.final_solution[agent.aid]
+                    produced[agent_type]["setpoints"][agent.aid] = value
+            else:
+                actuator(0)
+        if self.performance_logging:
+            self.step_summary["produced"] = {
+                agent_type: values["produced"] for agent_type, values in produced.items()
+            }
+        else:
+            print(f"PRODUCED {self.time} {produced}")
 
     async def run_step(self, sensors, actuators):
         self.time += self.step_size
         self.initial_generator_values = {}
         self.final_solution = {}
-        self.update_flexibilities(sensors)
+        with self.measure("update_flexibilities"):
+            self.update_flexibilities(sensors)
+        if self.incremental_negotiation:
+            with self.measure("carry_over_allocations"):
+                self.carry_over_allocations()
         await self.run_negotiations(sensors)
-        self.save_negotiated_solution_by_load()
-        self.save_number_of_sent_msg()
-        self.set_actuator_setpoints(actuators)
+        with self.measure("save_negotiated_solution_by_load"):
+            self.save_negotiated_solution_by_load()
+        with self.measure("save_number_of_sent_msg"):
+            self.save_number_of_sent_msg()
+        with self.measure("set_actuator_setpoints"):
+            self.set_actuator_setpoints(actuators)
 
     async def run_winzent(
             self, sensors, actuators_available, is_terminal=False
     ):
         logger.info("Winzent next step running")
+        self.step_statistics = {}
         grid_json = WinzentSensorActuatorUtil.get_grid_json_from_sensors(
             sensors
         )
 
         # initialize Winzent
         if not self.initialized:
-            if grid_json:
+            if grid_json or self.topology_artifact:
                 logger.info("Winzent is initializing")
                 self.winzent_mas = WinzentMAS(
                     ttl=self.ttl,
@@ -304,6 +731,8 @@ class WinzentMuscle(Muscle):
                     use_ethics_score_as_contributor=self.use_ethics_score_as_contributor,
                     request_processing_waiting_time=self.request_processing_waiting_time,
                     reply_processing_waiting_time=self.reply_processing_waiting_time,
+                    hierarchical=self.hierarchical_negotiation,
+                    topology_artifact=self.topology_artifact,
                 )
                 await self.winzent_mas.create_winzent_agents()
                 self.winzent_mas.build_topology()
@@ -326,55 +755,97 @@ class WinzentMuscle(Muscle):
             grid_json = self.initial_grid_json
 
         if grid_json:
-            self.winzent_mas.check_changes_and_update_topolgy(grid_json)
-            logger.debug("Topology was updated")
+            with self.measure("topology_update"):
+                self.winzent_mas.check_changes_and_update_topolgy(grid_json)
+            logger.debug(
+                "Topology was updated (cache hits: %s)", self.winzent_mas.topology_cache_hits
+            )
         else:
             logger.info("No grid json received, don't update topology")
 
         # logging
-        for agents in self.winzent_mas.winzent_agents.values():
-            for agent in agents.values():
-                logger.debug(
-                    f"{agent.aid} {agent.elem_type} index: {agent.index} with {agent.neighbors}"
-                )
+        if logger.isEnabledFor(logging.DEBUG):
+            for agents in self.winzent_mas.winzent_agents.values():
+                for agent in agents.values():
+                    if self.is_agent_logged(agent):
+                        logger.debug(
+                            "%s %s index: %s with %s", agent.aid, agent.elem_type, agent.index, agent.neighbors
+                        )
 
-        start_time = time.time()
+        start_time = time.perf_counter()
         # run a Winzent step
         await self.run_step(sensors, actuators_available)
-        runtime = time.time() - start_time
+        runtime = time.perf_counter() - start_time
 
         # logging information
         network_flexibility = 0
         for i in self.initial_generator_values.values():
             network_flexibility += i
 
-        needed_load = 0
-        for sensor in sensors:
-            if "load" in sensor.id:
-                needed_load += sensor.sensor_value * self.factor_mw
+        needed_load = float(self.sensor_values[2].sum()) * self.factor_mw
 
         actual_value = 0
         for i in self.final_solution.values():
             actual_value += i
-        logger.info(
-            f"Flexibility of the network: (0, {network_flexibility}) [{network_flexibility / self.factor_mw}] \n"
-            f"Needed Loads: {needed_load} [{needed_load / self.factor_mw}] \n "
-            f"Actual negotiated value: {actual_value} [{actual_value / self.factor_mw}] \n"
-            f"Messages sent: {self.messages_sent_in_step} \n"
-            f"Runtime: {runtime}"
-        )
-        logger.info(
-            "network flexibility, needed loads, negotiated value, number of sent messages, runtime"
-        )
-        logger.info(
-            f"{network_flexibility / self.factor_mw}, {needed_load / self.factor_mw}, {actual_value / self.factor_mw}, "
-            f"{self.messages_sent_in_step}, {runtime}"
+        self.step_statistics.update(
+            runtime=runtime,
+            messages=self.messages_sent_in_step,
+            demand=needed_load / self.factor_mw,
+            supply=network_flexibility / self.factor_mw,
+            negotiated=actual_value / self.factor_mw,
         )
+        if self.performance_logging:
+            self.step_summary.update(
+                time=self.time,
+                network_flexibility=network_flexibility / self.factor_mw,
+                needed_load=needed_load / self.factor_mw,
+                negotiated=actual_value / self.factor_mw,
+                messages=self.messages_sent_in_step,
+                runtime=runtime,
+                statistics=dict(self.step_statistics),
+            )
+            logger.info("Winzent step summary: %s", self.step_summary, extra={"winzent_step": self.step_summary})
+            self.step_summary = {}
+        else:
+            logger.info(
+                f"Flexibility of the network: (0, {network_flexibility}) [{network_flexibility / self.factor_mw}] \n"
+                f"Needed Loads: {needed_load} [{needed_load / self.factor_mw}] \n "
+                f"Actual negotiated value: {actual_value} [{actual_value / self.factor_mw}] \n"
+                f"Messages sent: {self.messages_sent_in_step} \n"
+                f"Runtime: {runtime}"
+            )
+            logger.info(
+                "network flexibility, needed loads, negotiated value, number of sent messages, runtime"
+            )
+            logger.info(
+                f"{network_flexibility / self.factor_mw}, {needed_load / self.factor_mw}, {actual_value / self.factor_mw}, "
+                f"{self.messages_sent_in_step}, {runtime}"
+            )
 
         if is_terminal:
-            await self.winzent_mas.shutdown()
-            logger.info("Winzent has shut down all agents")
-        logger.info(f"Winzent step {self.time} finished")
+            if self.ethics_score_record_path is not None:
+                self.ethics_score_recorder.flush(self.ethics_score_record_path, self.episode)
+            else:
+                self.ethics_score_recorder.clear()
+            self.episode += 1
+            if self.reuse_mas_across_episodes:
+                self.reset_episode()
+                logger.info("Winzent has reset all agents for the next episode")
+            else:
+                await self.winzent_mas.shutdown()
+                logger.info("Winzent has shut down all agents")
+        logger.info("Winzent step %s finished", self.time)
+
+    def reset_episode(self):
+        """resets the muscle and the agents to the state of the first step of an episode"""
+        self.winzent_mas.reset_episode()
+        self.time = self.step_size
+        self.initial_generator_values = {}
+        self.rounded_load_values = {}
+        self.final_solution = {}
+        self.remaining_flexibility = {}
+        self.previous_allocation = {}
+        self.reset_ethics_score_list()
 
     def propose_actions(
             self, sensors, actuators_available, is_terminal=False
@@ -385,25 +856,28 @@ class WinzentMuscle(Muscle):
 
         # sensor list: SensorInformation(value=1, observation_space=Discrete(2), sensor_id=myenv.0),
         # with all the sensors that the agent is given in the erd
-        nest_asyncio.apply()
-        asyncio.run(
+        self.event_loop.run(
             self.run_winzent(sensors, actuators_available, is_terminal)
         )
+        if is_terminal and not self.reuse_mas_across_episodes:
+            # all agents have been shut down
+            self.event_loop.stop()
 
         # only first list will be sent to environment, rest is for brain
         return (
             actuators_available,
             actuators_available,
             [1 for _ in actuators_available],
-            {},
+            dict(self.step_statistics),
         )
 
     def save_ethics_score_development(self, ethics_score_list, agent, success):
-        print(f"save ethics score from {agent.aid}")
         ethics_score_tiers = list(ethics_score_list.keys())
-        if success == False and agent.ethics_score >= ethics_score_tiers[0]:
+        if success == False and agent.ethics_score >= ethics_score_tiers[0] and self.is_agent_logged(agent):
             logger.info(
-                f"{agent.aid}: High priority target not supplied.\n Solution is {agent.result} and target supply is {self.rounded_load_values[agent.aid]}")
+                "%s: High priority target not supplied.\n Solution is %s and target supply is %s",
+                agent.aid, agent.result, self.rounded_load_values[agent.aid],
+            )
         for tier in ethics_score_tiers:
             if tier <= agent.ethics_score < tier + 1.0:
                 ethics_score_list[tier][0] = ethics_score_list[tier][0] + agent.ethics_score
@@ -411,32 +885,28 @@ class WinzentMuscle(Muscle):
                 if not success:
                     ethics_score_list[tier][1] += 1
 
-    def calculate_new_ethics_score(self, success, ethics_score):
-        max_len_of_ethics_score = "{:." + str(len(str(self.decay_rate).replace('.', ''))) + "f}"
-        initial_ethics_score = float(math.floor(ethics_score))
-        str_eth_score = list(str(ethics_score))
-        str_eth_score[0] = "0"
-        str_eth_score = float("".join(str_eth_score))
-        amount_of_outages = int(str_eth_score / self.sub_tier_size)
-        current_tier_low = max(float(str(ethics_score)[0]) + (amount_of_outages * (self.sub_tier_size)),
-                               initial_ethics_score)
-        current_tier_high = max(float(str(ethics_score)[0]) + ((amount_of_outages + 1) * self.sub_tier_size),
-                                initial_ethics_score)
-        if not success:
-            temp = math.floor(ethics_score * 10) / 10
-            if (math.floor(float(temp)) + 1) > (float(temp) + self.sub_tier_size):
-                if ethics_score == initial_ethics_score:
-                    return float(
-                        max_len_of_ethics_score.format(initial_ethics_score + self.sub_tier_size - self.decay_rate))
-                return float(max_len_of_ethics_score.format(current_tier_high + self.sub_tier_size - self.decay_rate))
-            else:
-                return float(max_len_of_ethics_score.format((math.floor(float(ethics_score)) + 1) - self.decay_rate))
-        else:
-            temp_ethics_score = float(max_len_of_ethics_score.format(ethics_score - self.decay_rate))
-            if temp_ethics_score <= current_tier_low:
-                return current_tier_low
-            else:
-                return temp_ethics_score
+    @contextlib.contextmanager
+    def measure(self, phase):
+        """adds the runtime of the block to the runtime of the phase in the step statistics"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            key = f"runtime_{phase}"
+            self.step_statistics[key] = self.step_statistics.get(key, 0.0) + time.perf_counter() - start_time
+
+    def count(self, name, number=1):
+        """adds number to the counter name of the step statistics"""
+        self.step_statistics[name] = self.step_statistics.get(name, 0) + number
+
+    def is_agent_logged(self, agent):
+        """
+        in performance logging mode only the details of a fixed sample of the agents are
+        logged (selected by a hash of the aid), otherwise the details of all agents
+        """
+        if not self.performance_logging:
+            return True
+        return zlib.crc32(agent.aid.encode()) < self.agent_log_sample_rate * 2 ** 32
 
     def setup(self):
         pass
@@ -2,12 +2,16 @@ import asyncio
 import logging
 import math
 import time
-from typing import Optional, Dict, List, Tuple
+import zlib
+from collections import deque
+from typing import Deque, Optional, Dict, List, Tuple
 
 import nest_asyncio
 from palaestrai.agent import Muscle, SensorInformation, ActuatorInformation
 
+from .winzent_ethics import EthicsScoreModel
 from .winzent_mas import WinzentMAS
+from .winzent_negotiation import NegotiationTracker
 from .winzent_util import WinzentSensorActuatorUtil
 from mango_library.negotiation.winzent.winzent_base_agent import WinzentBaseAgent
 
@@ -31,9 +35,22 @@ class WinzentMuscle(Muscle):
         self.reply_processing_waiting_time = params.get("reply_processing_waiting_time", 0.4)
         self.use_producer_ethics_score = params.get("use_producer_ethics_score", True)
         self.use_consumer_ethics_score = params.get("use_consumer_ethics_score", True)
+        # wall-clock limit for all negotiations of a step (default: three negotiation rounds)
+        self.step_timeout = params.get("step_timeout", self.time_to_sleep * 3 * 3)
+        # number of slots negotiated in one round; the results for the later slots are
+        # used in the following steps
+        self.horizon = params.get("horizon", 1)
+        # relative deviation of the demand from its forecast up to which a result is reused
+        self.horizon_tolerance = params.get("horizon_tolerance", 0.05)
+        self.slots_per_day = 24 * 60 * 60 // self.step_size
+        # log one summary record per step instead of the per-agent details and prints
+        self.performance_logging = params.get("performance_logging", False)
+        # share of the agents whose details are logged in performance logging mode
+        self.agent_log_sample_rate = params.get("agent_log_sample_rate", 0.0)
 
         self.decay_rate = 0
         self.sub_tier_size = 0
+        self.ethics_score_model: Optional[EthicsScoreModel] = None
         self.ethics_score_list = {}
         self.calc_ethics_score_params()
 
@@ -55,12 +72,22 @@ class WinzentMuscle(Muscle):
         self.rounded_load_values: Dict[str:int] = {}
         self.final_solution = {}
 
+        # aid -> observed demand (loads) or flexibility (sgens) of the last day, one per step
+        self.sensor_history: Dict[str, Deque[float]] = {}
+        # slot -> {load aid: (forecasted demand, {sgen aid: value})} negotiated in earlier steps
+        self.slot_cache: Dict[int, Dict[str, Tuple[int, Dict[str, int]]]] = {}
+        # load aid -> {sgen aid: value} for the current slot
+        self.slot_results: Dict[str, Dict[str, int]] = {}
+
         self.messages_sent_in_step = 0
+        # performance logging: values of the current step logged in one record
+        self.step_summary = {}
 
     def calc_ethics_score_params(self):
         total_amount_of_steps = self.end / self.step_size
         self.sub_tier_size = 1.0 / total_amount_of_steps
         self.decay_rate = self.sub_tier_size / total_amount_of_steps
+        self.ethics_score_model = EthicsScoreModel(self.sub_tier_size, self.decay_rate)
         self.reset_ethics_score_list()
 
     def reset_ethics_score_list(self):
@@ -115,6 +142,7 @@ class WinzentMuscle(Muscle):
                 if agent.elem_type == "sgen" and sensor_type == "p_mw_flex":
                     flexibility = sensor.sensor_value * self.factor_mw
                     self.initial_generator_values[agent.aid] = flexibility
+                    self.record_sensor_value(agent.aid, flexibility)
                     agent.update_flexibility(
                         t_start=self.time,
                         min_p=0,
@@ -125,32 +153,132 @@ class WinzentMuscle(Muscle):
                     self.rounded_load_values[agent.aid] = math.ceil(
                         sensor.sensor_value * self.factor_mw
                     )
+                    self.record_sensor_value(agent.aid, self.rounded_load_values[agent.aid])
                     agent.update_flexibility(
                         t_start=self.time, min_p=0, max_p=0
                     )
 
-        logger.debug(
-            f"initial generator values: {self.initial_generator_values}"
-        )
+        logger.debug("initial generator values: %s", self.initial_generator_values)
+
+    def record_sensor_value(self, aid, value):
+        if aid not in self.sensor_history:
+            self.sensor_history[aid] = deque(maxlen=self.slots_per_day)
+        self.sensor_history[aid].append(value)
+
+    def forecast(self, aid, steps_ahead):
+        """
+        forecasts the demand or flexibility of the agent in the slot steps_ahead steps
+        after the current one: the value observed one day before that slot or, without a
+        full day of history, the last observed value
+        """
+        history = self.sensor_history.get(aid)
+        if not history:
+            return 0
+        if len(history) == self.slots_per_day:
+            return history[steps_ahead - 1]
+        return history[-1]
+
+    def get_results_by_slot(self, agent) -> Dict[int, Dict[str, int]]:
+        """returns the values negotiated by the agent per slot (slot -> {sgen aid: value})"""
+        results = {}
+        for sgen, values_by_slot in agent.final.items():
+            for slot, values in values_by_slot.items():
+                results.setdefault(int(slot), {})
+                results[int(slot)][sgen] = results[int(slot)].get(sgen, 0) + abs(values[0])
+        return results
+
+    def serve_from_cache(self, loads):
+        """
+        uses the results negotiated in earlier steps for the current slot if the demand of
+        the load is close to the forecast it was negotiated for and the sgens still have
+        the flexibility. Returns the flexibility left per sgen and the loads that had a
+        result for the current slot.
+        """
+        cached = self.slot_cache.pop(self.time, {})
+        free_flexibility = {
+            aid: math.floor(flexibility) for aid, flexibility in self.initial_generator_values.items()
+        }
+        for agent in sorted(loads, key=lambda load: load.ethics_score, reverse=True):
+            if agent.aid not in cached:
+                continue
+            forecast, result = cached[agent.aid]
+            demand = self.rounded_load_values[agent.aid]
+            if abs(demand - forecast) > self.horizon_tolerance * demand:
+                continue
+            if any(free_flexibility.get(sgen, 0) < value for sgen, value in result.items()):
+                continue
+            served = {}
+            for sgen, value in result.items():
+                value = min(value, demand - sum(served.values()))
+                if value <= 0:
+                    break
+                served[sgen] = value
+                free_flexibility[sgen] -= value
+            self.slot_results[agent.aid] = served
+        logger.debug("%s loads are served from earlier negotiations", len(self.slot_results))
+        return free_flexibility, set(cached.keys())
+
+    def update_horizon_flexibilities(self, free_flexibility):
+        """offers the flexibility that is not committed yet for the current and the following slots"""
+        for aid, flexibility in free_flexibility.items():
+            agent = self.winzent_mas.aid_agent_mapping[aid]
+            if flexibility < math.floor(self.initial_generator_values[aid]):
+                agent.update_flexibility(t_start=self.time, min_p=0, max_p=flexibility)
+            for steps_ahead in range(1, self.horizon):
+                slot = self.time + steps_ahead * self.step_size
+                committed = sum(
+                    result.get(aid, 0) for _, result in self.slot_cache.get(slot, {}).values()
+                )
+                agent.update_flexibility(
+                    t_start=slot,
+                    min_p=0,
+                    max_p=max(math.floor(self.forecast(aid, steps_ahead)) - committed, 0),
+                )
 
     async def run_negotiations(self, sensors):
         self.messages_sent_in_step = 0
-        agents_with_started_negotiation = []
-        time_span = [self.time]
-        # start a negotiation for every load with the new value
-        for sensor, (sensor_type, agent) in zip(sensors, self.sensor_mapping):
-            if sensor_type == "p_mw" and agent is not None:
-                if agent.elem_type == "load":
-                    if sensor.sensor_value > 0:
-                        # only start negotiation if value is larger than 0
-                        logger.debug(
-                            f"Start negotiation for {agent.aid} with value {math.ceil(sensor.sensor_value * self.factor_mw)}"
-                        )
-                        await agent.start_negotiation(
-                            start_dates=time_span,
-                            values=[math.ceil(sensor.sensor_value * self.factor_mw)],
-                        )
-                        agents_with_started_negotiation.append(agent)
+        negotiations = NegotiationTracker(self.step_timeout)
+        loads = [
+            agent for sensor, (sensor_type, agent) in zip(sensors, self.sensor_mapping)
+            if sensor_type == "p_mw" and agent is not None and agent.elem_type == "load"
+            and sensor.sensor_value > 0
+        ]
+        free_flexibility, loads_with_cached_result = self.serve_from_cache(loads)
+        self.update_horizon_flexibilities(free_flexibility)
+        served_from_cache = dict(self.slot_results)
+        # slot -> value negotiated for the slot, per load
+        negotiated_values: Dict[str, Dict[int, int]] = {}
+        # start a negotiation for every load with the missing value of the current slot.
+        # Loads without results from an earlier round also negotiate the forecasted demand
+        # of the following slots, the others only renegotiate the deviating current slot.
+        for agent in loads:
+            negotiated_values[agent.aid] = {}
+            value = self.rounded_load_values[agent.aid] - sum(self.slot_results.get(agent.aid, {}).values())
+            if value > 0:
+                negotiated_values[agent.aid][self.time] = value
+            if agent.aid in loads_with_cached_result:
+                steps_ahead_to_negotiate = []
+            else:
+                steps_ahead_to_negotiate = range(1, self.horizon)
+            for steps_ahead in steps_ahead_to_negotiate:
+                slot = self.time + steps_ahead * self.step_size
+                if agent.aid not in self.slot_cache.get(slot, {}):
+                    forecast = math.ceil(self.forecast(agent.aid, steps_ahead))
+                    if forecast > 0:
+                        negotiated_values[agent.aid][slot] = forecast
+            if self.time not in negotiated_values[agent.aid]:
+                # the current slot is served completely, only later slots are negotiated
+                agent.ethics_score = self.calculate_new_ethics_score(True, agent.ethics_score)
+                self.save_ethics_score_development(self.ethics_score_list, agent, True)
+            if not negotiated_values[agent.aid]:
+                continue
+            if self.is_agent_logged(agent):
+                logger.debug("Start negotiation for %s with values %s", agent.aid, negotiated_values[agent.aid])
+            await agent.start_negotiation(
+                start_dates=list(negotiated_values[agent.aid].keys()),
+                values=list(negotiated_values[agent.aid].values()),
+            )
+            negotiations.add(agent, timeout=agent.time_to_sleep * 3)
 
         number_of_restarted_negotiations = (
             self.number_of_restartable_negotiations
@@ -160,69 +288,76 @@ class WinzentMuscle(Muscle):
             "All initial negotiations started; waiting for negotiations to be done and restarting "
             "unsuccessful negotiations"
         )
-        # waiting for all negotiations to finish
-        while len(agents_with_started_negotiation) > 0:
-            agent = agents_with_started_negotiation.pop(0)
-            try:
-                await asyncio.wait_for(agent.negotiation_done, timeout=agent.time_to_sleep * 3)
-                logger.debug(f"{agent.aid} negotiation done")
-                # restart unsuccessful negotiations
-                # only allow a restricted number of restarts
-                agent_result_sum = []
-                for time_slot in time_span:
-                    agent_result_sum.append(0)
-                for key in agent.final:
-                    it = 0
-                    for sub_key in agent.final[key]:
-                        agent_result_sum[it] += abs(agent.final[key][sub_key][0])
-                        it += 1
+        # handle every negotiation as soon as it is done
+        while len(negotiations) > 0:
+            finished_agents, timed_out_agents = await negotiations.wait()
+            for agent in timed_out_agents:
+                logger.error(
+                    "%s could not finish its negotiation in time. No restart permission can be given.", agent.aid
+                )
+                agent.ethics_score = self.calculate_new_ethics_score(False, agent.ethics_score)
+                self.save_ethics_score_development(self.ethics_score_list, agent, False)
+            for agent in finished_agents:
+                if self.is_agent_logged(agent):
+                    logger.debug("%s negotiation done", agent.aid)
+                results_by_slot = self.get_results_by_slot(agent)
+                # results for the following slots are used in the next steps
+                for slot, result in results_by_slot.items():
+                    if slot != self.time and slot in negotiated_values[agent.aid]:
+                        self.slot_cache.setdefault(slot, {})[agent.aid] = (
+                            negotiated_values[agent.aid][slot], result
+                        )
+                if self.time not in negotiated_values[agent.aid]:
+                    continue
+                self.slot_results[agent.aid] = dict(served_from_cache.get(agent.aid, {}))
+                for sgen, value in results_by_slot.get(self.time, {}).items():
+                    self.slot_results[agent.aid][sgen] = self.slot_results[agent.aid].get(sgen, 0) + value
+                agent_result_sum = sum(self.slot_results[agent.aid].values())
                 # check if negotiation fulfills requirements
                 negotiation_successful = agent_result_sum >= self.rounded_load_values[agent.aid]
-                if not negotiation_successful:
-                    if number_of_restarted_negotiations > 0:
-                        # get sum of already negotiated values for this agent
-                        # negotiation was not fully successful, therefore restart
-                        agents_with_started_negotiation.append(agent)
-                        # restart the negotiation with the missing value
-                        await agent.start_negotiation(
-                            start_dates=time_span,
-                            values=[self.rounded_load_values[agent.aid]
-                                  - agent_result_sum],
-                        )
+                if not negotiation_successful and number_of_restarted_negotiations > 0:
+                    # negotiation was not fully successful, therefore restart the negotiation
+                    # of the current slot with the missing value
+                    await agent.start_negotiation(
+                        start_dates=[self.time],
+                        values=[self.rounded_load_values[agent.aid] - agent_result_sum],
+                    )
+                    negotiations.add(agent, timeout=agent.time_to_sleep * 3)
+                    if self.is_agent_logged(agent):
                         logger.debug(
-                            f"{agent.aid} restarted negotiation for value "
-                            f"of {self.rounded_load_values[agent.aid] - agent_result_sum}"
-                        )
-                        number_of_restarted_negotiations -= 1
-                    elif agent_result_sum > self.rounded_load_values[agent.aid]:
-                        logger.error(
-                            f"Too much power: {agent.aid} has with a sum of {agent_result_sum} instead of "
-                            f"{self.rounded_load_values[agent.aid]} from the result:{agent.result} "
-                            f"not a feasible solution"
+                            "%s restarted negotiation for value of %s",
+                            agent.aid, self.rounded_load_values[agent.aid] - agent_result_sum,
                         )
-                    else:
-                        agent.ethics_score = self.calculate_new_ethics_score(negotiation_successful, agent.ethics_score)
-                        self.save_ethics_score_development(self.ethics_score_list, agent, negotiation_successful)
+                    number_of_restarted_negotiations -= 1
                 else:
                     agent.ethics_score = self.calculate_new_ethics_score(negotiation_successful, agent.ethics_score)
                     self.save_ethics_score_development(self.ethics_score_list, agent, negotiation_successful)
-            except asyncio.TimeoutError:
-                logger.error(f"{agent.aid} could not finish its negotiation in time. No restart permission can be given.")
-                agent.ethics_score = self.calculate_new_ethics_score(False, agent.ethics_score)
-                self.save_ethics_score_development(self.ethics_score_list, agent, False)
-        logger.info(f"ethics_scores -->{self.ethics_score_list}")
+        if self.performance_logging:
+            self.step_summary["ethics_scores"] = {
+                tier: list(values) for tier, values in self.ethics_score_list.items()
+            }
+        else:
+            logger.info("ethics_scores -->%s", self.ethics_score_list)
         self.reset_ethics_score_list()
 
     def save_negotiated_solution_by_load(self):
         self.final_solution = {}
-        for agent in self.winzent_mas.winzent_agents["load"].values():
-            logger.debug(f"muscle: LOAD {agent.aid} result:{agent.result}")
-            for sgen in agent.result.keys():
+        log_results = logger.isEnabledFor(logging.DEBUG)
+        for aid, result in self.slot_results.items():
+            if log_results and self.is_agent_logged(self.winzent_mas.aid_agent_mapping[aid]):
+                logger.debug("muscle: LOAD %s result:%s", aid, result)
+            for sgen in result.keys():
                 if sgen not in self.final_solution.keys():
                     self.final_solution[sgen] = 0
-                self.final_solution[sgen] += agent.result[sgen]
+                self.final_solution[sgen] += result[sgen]
+        self.slot_results = {}
+        for agent in self.winzent_mas.winzent_agents["load"].values():
             # reset result for next step
             agent.result = {}
+            agent.final = {}
+        # results of slots that have passed are not needed anymore
+        for slot in [slot for slot in self.slot_cache if slot <= self.time]:
+            del self.slot_cache[slot]
 
     def save_number_of_sent_msg(self):
         """
@@ -237,14 +372,15 @@ class WinzentMuscle(Muscle):
     def set_actuator_setpoints(self, actuators_available):
         # after negotiation fetch the results and give them to the actuators
         # for later winzent versions
-        logger.debug("final solution of what winzent has negotiated")
-        logger.debug(self.final_solution)
-        logger.info(f"agent types: {self.winzent_mas.agent_types}")
+        logger.debug("final solution of what winzent has negotiated: %s", self.final_solution)
+        if not self.performance_logging:
+            logger.info("agent types: %s", self.winzent_mas.agent_types)
+        # agent type -> {"produced": total value, "setpoints": {aid: setpoint}}
+        produced = {}
         for actuator, (actuator_type, agent) in zip(
                 actuators_available, self.actuator_mapping
         ):
             if actuator_type == "scaling" and agent is not None:
-                logger.debug(self.final_solution)
                 if (
                         agent.aid in self.final_solution
                         and self.initial_generator_values[agent.aid] > 0
@@ -254,11 +390,16 @@ class WinzentMuscle(Muscle):
                             self.final_solution[agent.aid]
                             / self.initial_generator_values[agent.aid]
                     )
-                    logger.debug(
-                        f"final solution: {self.final_solution[agent.aid]} and initial generator values {self.initial_generator_values[agent.aid]}; actuator value = {value}"
-                    )
+                    if self.is_agent_logged(agent):
+                        logger.debug(
+                            "final solution: %s and initial generator values %s; actuator value = %s",
+                            self.final_solution[agent.aid], self.initial_generator_values[agent.aid], value,
+                        )
                     if value > 1:
-                        logger.info(f"final solution: {self.final_solution[agent.aid]} and initial generator values {self.initial_generator_values[agent.aid]}; actuator value = {value}")
+                        logger.info(
+                            "final solution: %s and initial generator values %s; actuator value = %s",
+                            self.final_solution[agent.aid], self.initial_generator_values[agent.aid], value,
+                        )
                         value = 1
                         logger.info(
                             "WARNING: Invalid Winzent result detected."
@@ -266,12 +407,20 @@ class WinzentMuscle(Muscle):
                             "avoid the experiment from crashing."
                         )
                     actuator(value)
-                    for key, value_list in self.winzent_mas.agent_types.items():
-                        if agent.aid in value_list:
-                            print(f"PRODUCED {self.final_solution[agent.aid]} {key} {value} {agent.aid}")
+                    agent_type = self.winzent_mas.agent_type_of.get(agent.aid)
+                    if agent_type is not None:
+                        if agent_type not in produced:
+                            produced[agent_type] = {"produced": 0, "setpoints": {}}
+                        produced[agent_type]["produced"] += self.final_solution[agent.aid]
+                        produced[agent_type]["setpoints"][agent.aid] = value
                 else:
-                    logger.debug("actuator set to zero")
                     actuator(0)
+        if self.performance_logging:
+            self.step_summary["produced"] = {
+                agent_type: values["produced"] for agent_type, values in produced.items()
+            }
+        else:
+            print(f"PRODUCED {self.time} {produced}")
 
     async def run_step(self, sensors, actuators):
         self.time += self.step_size
@@ -301,8 +450,8 @@ class WinzentMuscle(Muscle):
                     grid_json=grid_json,
                     send_message_paths=self.send_message_paths,
                     ethics_score_config = self.ethics_score_config,
-                    use_consumer_ethics_score=self.use_consumer_ethics_score,
-                    use_producer_ethics_score=self.use_producer_ethics_score,
+                    use_ethics_score_as_negotiator=self.use_consumer_ethics_score,
+                    use_ethics_score_as_contributor=self.use_producer_ethics_score,
                     request_processing_waiting_time=self.request_processing_waiting_time,
                     reply_processing_waiting_time=self.reply_processing_waiting_time,
                 )
@@ -328,16 +477,20 @@ class WinzentMuscle(Muscle):
 
         if grid_json:
             self.winzent_mas.check_changes_and_update_topolgy(grid_json)
-            logger.debug("Topology was updated")
+            logger.debug(
+                "Topology was updated (cache hits: %s)", self.winzent_mas.topology_cache_hits
+            )
         else:
             logger.info("No grid json received, don't update topology")
 
         # logging
-        for agents in self.winzent_mas.winzent_agents.values():
-            for agent in agents.values():
-                logger.debug(
-                    f"{agent.aid} {agent.elem_type} index: {agent.index} with {agent.neighbors}"
-                )
+        if logger.isEnabledFor(logging.DEBUG):
+            for agents in self.winzent_mas.winzent_agents.values():
+                for agent in agents.values():
+                    if self.is_agent_logged(agent):
+                        logger.debug(
+                            "%s %s index: %s with %s", agent.aid, agent.elem_type, agent.index, agent.neighbors
+                        )
 
         start_time = time.time()
         # run a Winzent step
@@ -357,25 +510,37 @@ class WinzentMuscle(Muscle):
         actual_value = 0
         for i in self.final_solution.values():
             actual_value += i
-        logger.info(
-            f"Flexibility of the network: (0, {network_flexibility}) [{network_flexibility / self.factor_mw}] \n"
-            f"Needed Loads: {needed_load} [{needed_load / self.factor_mw}] \n "
-            f"Actual negotiated value: {actual_value} [{actual_value / self.factor_mw}] \n"
-            f"Messages sent: {self.messages_sent_in_step} \n"
-            f"Runtime: {runtime}"
-        )
-        logger.info(
-            "network flexibility, needed loads, negotiated value, number of sent messages, runtime"
-        )
-        logger.info(
-            f"{network_flexibility / self.factor_mw}, {needed_load / self.factor_mw}, {actual_value / self.factor_mw}, "
-            f"{self.messages_sent_in_step}, {runtime}"
-        )
+        if self.performance_logging:
+            self.step_summary.update(
+                time=self.time,
+                network_flexibility=network_flexibility / self.factor_mw,
+                needed_load=needed_load / self.factor_mw,
+                negotiated=actual_value / self.factor_mw,
+                messages=self.messages_sent_in_step,
+                runtime=runtime,
+            )
+            logger.info("Winzent step summary: %s", self.step_summary, extra={"winzent_step": self.step_summary})
+            self.step_summary = {}
+        else:
+            logger.info(
+                f"Flexibility of the network: (0, {network_flexibility}) [{network_flexibility / self.factor_mw}] \n"
+                f"Needed Loads: {needed_load} [{needed_load / self.factor_mw}] \n "
+                f"Actual negotiated value: {actual_value} [{actual_value / self.factor_mw}] \n"
+                f"Messages sent: {self.messages_sent_in_step} \n"
+                f"Runtime: {runtime}"
+            )
+            logger.info(
+                "network flexibility, needed loads, negotiated value, number of sent messages, runtime"
+            )
+            logger.info(
+                f"{network_flexibility / self.factor_mw}, {needed_load / self.factor_mw}, {actual_value / self.factor_mw}, "
+                f"{self.messages_sent_in_step}, {runtime}"
+            )
 
         if is_terminal:
             await self.winzent_mas.shutdown()
             logger.info("Winzent has shut down all agents")
-        logger.info(f"Winzent step {self.time} finished")
+        logger.info("Winzent step %s finished", self.time)
 
     def propose_actions(
             self, sensors, actuators_available, is_terminal=False
@@ -400,10 +565,13 @@ class WinzentMuscle(Muscle):
         )
 
     def save_ethics_score_development(self, ethics_score_list, agent, success):
-        print(f"save ethics score from {agent.aid}")
+        logger.debug("save ethics score from %s", agent.aid)
         ethics_score_tiers = list(ethics_score_list.keys())
-        if success == False and agent.ethics_score >= ethics_score_tiers[0]:
-            logger.info(f"{agent.aid}: High priority target not supplied.\n Solution is {agent.result_sum} and target supply is {self.rounded_load_values[agent.aid]}")
+        if success == False and agent.ethics_score >= ethics_score_tiers[0] and self.is_agent_logged(agent):
+            logger.info(
+                "%s: High priority target not supplied.\n Solution is %s and target supply is %s",
+                agent.aid, agent.result_sum, self.rounded_load_values[agent.aid],
+            )
         for tier in ethics_score_tiers:
             if tier <= agent.ethics_score < tier + 1.0:
                 ethics_score_list[tier][0] = ethics_score_list[tier][0] + agent.ethics_score
@@ -411,32 +579,18 @@ class WinzentMuscle(Muscle):
                 if not success:
                     ethics_score_list[tier][1] += 1
 
+    def is_agent_logged(self, agent):
+        """
+        in performance logging mode only the details of a fixed sample of the agents are
+        logged (selected by a hash of the aid), otherwise the details of all agents
+        """
+        if not self.performance_logging:
+            return True
+        return zlib.crc32(agent.aid.encode()) < self.agent_log_sample_rate * 2 ** 32
+
     def calculate_new_ethics_score(self, success, ethics_score):
-        max_len_of_ethics_score = "{:." + str(len(str(self.decay_rate).replace('.', ''))) + "f}"
-        initial_ethics_score = float(math.floor(ethics_score))
-        str_eth_score = list(str(ethics_score))
-        str_eth_score[0] = "0"
-        str_eth_score = float("".join(str_eth_score))
-        amount_of_outages = int(str_eth_score / self.sub_tier_size)
-        current_tier_low = max(float(str(ethics_score)[0]) + (amount_of_outages * (self.sub_tier_size)),
-                               initial_ethics_score)
-        current_tier_high = max(float(str(ethics_score)[0]) + ((amount_of_outages + 1) * self.sub_tier_size),
-                                initial_ethics_score)
-        if not success:
-            temp = math.floor(ethics_score * 10) / 10
-            if (math.floor(float(temp)) + 1) > (float(temp) + self.sub_tier_size):
-                if ethics_score == initial_ethics_score:
-                    return float(
-                        max_len_of_ethics_score.format(initial_ethics_score + self.sub_tier_size - self.decay_rate))
-                return float(max_len_of_ethics_score.format(current_tier_high + self.sub_tier_size - self.decay_rate))
-            else:
-                return float(max_len_of_ethics_score.format((math.floor(float(ethics_score)) + 1) - self.decay_rate))
-        else:
-            temp_ethics_score = float(max_len_of_ethics_score.format(ethics_score - self.decay_rate))
-            if temp_ethics_score <= current_tier_low:
-                return current_tier_low
-            else:
-                return temp_ethics_score
+        """returns the new ethics score of a single agent (see EthicsScoreModel)"""
+        return self.ethics_score_model.update([ethics_score], [success]).tolist()[0]
 
     def setup(self):
         pass
@@ -0,0 +1,146 @@
+import math
+import random
+
+import numpy as np
+import pytest
+
+from ..winzent_ethics import EthicsScoreModel
+
+STEPS = [4, 10, 96, 672]
+TIERS = list(range(1, 10))
+
+
+def reference_ethics_score(success, ethics_score, sub_tier_size, decay_rate):
+    """the string based WinzentMuscle.calculate_new_ethics_score the model replaces"""
+    max_len_of_ethics_score = "{:." + str(len(str(decay_rate).replace('.', ''))) + "f}"
+    initial_ethics_score = float(math.floor(ethics_score))
+    str_eth_score = list(str(ethics_score))
+    str_eth_score[0] = "0"
+    str_eth_score = float("".join(str_eth_score))
+    amount_of_outages = int(str_eth_score / sub_tier_size)
+    current_tier_low = max(float(str(ethics_score)[0]) + (amount_of_outages * (sub_tier_size)),
+                           initial_ethics_score)
+    current_tier_high = max(float(str(ethics_score)[0]) + ((amount_of_outages + 1) * sub_tier_size),
+                            initial_ethics_score)
+    if not success:
+        temp = math.floor(ethics_score * 10) / 10
+        if (math.floor(float(temp)) + 1) > (float(temp) + sub_tier_size):
+            if ethics_score == initial_ethics_score:
+                return float(
+                    max_len_of_ethics_score.format(initial_ethics_score + sub_tier_size - decay_rate))
+            return float(max_len_of_ethics_score.format(current_tier_high + sub_tier_size - decay_rate))
+        else:
+            return float(max_len_of_ethics_score.format((math.floor(float(ethics_score)) + 1) - decay_rate))
+    else:
+        temp_ethics_score = float(max_len_of_ethics_score.format(ethics_score - decay_rate))
+        if temp_ethics_score <= current_tier_low:
+            return current_tier_low
+        else:
+            return temp_ethics_score
+
+
+def model_for(steps):
+    sub_tier_size = 1.0 / steps
+    return EthicsScoreModel(sub_tier_size, sub_tier_size / steps)
+
+
+def update(model, ethics_score, success):
+    return float(model.update([ethics_score], [success])[0])
+
+
+def is_sub_tier_boundary_difference(model, ethics_score):
+    """
+    True if the score starts a sub tier (not the tier) and the reference puts it into
+    the sub tier below, because the division of its float position by the sub tier
+    size rounds down (e.g. 0.3 / 0.1 == 2.9999999999999996)
+    """
+    position = int(model.to_ticks([ethics_score])[0]) % model.ticks_per_tier
+    sub_tier = position // model.ticks_per_sub_tier
+    # the reference reads the position from the string of the score
+    reference_position = float("0" + str(ethics_score)[1:])
+    return (
+            position > 0
+            and position % model.ticks_per_sub_tier == 0
+            and int(reference_position / (1.0 / model.ticks_per_sub_tier)) < sub_tier
+    )
+
+
+@pytest.mark.parametrize("tier", TIERS)
+@pytest.mark.parametrize("steps", STEPS)
+def test_chained_updates_match_reference(steps, tier):
+    model = model_for(steps)
+    sub_tier_size = 1.0 / steps
+    rng = random.Random(steps * 100 + tier)
+    for _ in range(10):
+        ethics_score = float(tier)
+        success_rate = rng.random()
+        for _ in range(2 * steps):
+            # the reference only reads the first digit of the tier
+            if ethics_score >= 10:
+                break
+            success = rng.random() < success_rate
+            expected = reference_ethics_score(success, ethics_score, sub_tier_size, model.decay_rate)
+            new_ethics_score = update(model, ethics_score, success)
+            if is_sub_tier_boundary_difference(model, ethics_score):
+                # the reference starts from the sub tier below (see test_sub_tier_boundaries)
+                difference = model.decay_rate if success else sub_tier_size
+                assert new_ethics_score - expected == pytest.approx(difference, abs=model.decay_rate / 2)
+            else:
+                assert new_ethics_score == pytest.approx(expected, abs=model.decay_rate / 2)
+            ethics_score = new_ethics_score
+
+
+@pytest.mark.parametrize(
+    "steps, ethics_score, success, expected, reference",
+    [
+        # a success keeps the score at the start of its sub tier, the reference decays below it
+        (10, 1.3, True, 1.3, 1.29),
+        (24, 1.0833333333333333, True, 1.0833333333333333, 1.081597222222222),
+        (96, 2.0104166666666665, True, 2.0104166666666665, 2.010308159722222),
+        # a failure moves the score to the end of the next sub tier, the reference to the end of its own
+        (10, 1.3, False, 1.49, 1.39),
+        (96, 2.0104166666666665, False, 2.0311414930555554, 2.0207248263888884),
+    ],
+)
+def test_sub_tier_boundaries(steps, ethics_score, success, expected, reference):
+    model = model_for(steps)
+    assert is_sub_tier_boundary_difference(model, ethics_score)
+    assert update(model, ethics_score, success) == pytest.approx(expected, abs=model.decay_rate / 2)
+    assert reference_ethics_score(
+        success, ethics_score, 1.0 / steps, model.decay_rate
+    ) == pytest.approx(reference, abs=model.decay_rate / 2)
+
+
+@pytest.mark.parametrize("steps", STEPS)
+@pytest.mark.parametrize("tier", [10, 12, 25])
+def test_tiers_from_ten_update_like_lower_tiers(steps, tier):
+    model = model_for(steps)
+    sub_tier_size = 1.0 / steps
+    assert update(model, float(tier), False) == pytest.approx(
+        tier + sub_tier_size - model.decay_rate, abs=model.decay_rate / 2
+    )
+    assert update(model, float(tier), True) == float(tier)
+    rng = random.Random(steps * 100 + tier)
+    ethics_score = 1.0
+    for _ in range(2 * steps):
+        success = rng.random() < 0.5
+        new_ethics_score = update(model, ethics_score, success)
+        # the same chain shifted by tier - 1, as long as it stays in the first tier
+        if new_ethics_score >= 2:
+            break
+        assert update(model, ethics_score + tier - 1, success) == pytest.approx(
+            new_ethics_score + tier - 1, abs=model.decay_rate / 2
+        )
+        ethics_score = new_ethics_score
+
+
+@pytest.mark.parametrize("steps", STEPS)
+def test_update_of_all_agents_at_once(steps):
+    model = model_for(steps)
+    rng = np.random.default_rng(steps)
+    ethics_scores = model.from_ticks(rng.integers(model.ticks_per_tier, 4 * model.ticks_per_tier, 500))
+    success = rng.random(500) < 0.5
+    at_once = model.update(ethics_scores, success)
+    one_by_one = [update(model, ethics_score, agent_success)
+                  for ethics_score, agent_success in zip(ethics_scores.tolist(), success.tolist())]
+    assert at_once.tolist() == one_by_one
@@ -0,0 +1,47 @@
+from typing import Tuple
+
+import numpy as np
+
+
+def allocate_leftover_flexibility(
+        demands: np.ndarray,
+        priorities: np.ndarray,
+        demand_components: np.ndarray,
+        supplies: np.ndarray,
+        supply_components: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Centralized allocation of leftover flexibility to loads without a negotiated supply.
+    Inside every connected component the loads are supplied in the order of their
+    priorities (highest first) as long as the flexibility of the component lasts. The
+    demand of every load is then covered by the sgens in their order: load and sgen are
+    matched where the intervals [cumulated demand before, cumulated demand) and
+    [cumulated supply before, cumulated supply) overlap.
+    Returns (load positions, sgen positions, values) of all non-zero allocations.
+    """
+    demands = np.asarray(demands, dtype=np.int64)
+    supplies = np.maximum(np.asarray(supplies, dtype=np.int64), 0)
+    load_positions, sgen_positions, values = [], [], []
+    for component in np.intersect1d(demand_components, supply_components):
+        loads = np.flatnonzero(demand_components == component)
+        loads = loads[np.argsort(-priorities[loads], kind="stable")]
+        sgens = np.flatnonzero((supply_components == component) & (supplies > 0))
+        if len(sgens) == 0:
+            continue
+        demand_ends = np.cumsum(demands[loads])
+        supply_ends = np.cumsum(supplies[sgens])
+        # every segment between two consecutive breakpoints belongs to one load and one sgen
+        breakpoints = np.union1d(demand_ends, supply_ends)
+        breakpoints = breakpoints[breakpoints <= supply_ends[-1]]
+        segment_starts = np.concatenate(([0], breakpoints[:-1]))
+        lengths = breakpoints - segment_starts
+        in_segment = (lengths > 0) & (segment_starts < demand_ends[-1])
+        segment_starts = segment_starts[in_segment]
+        lengths = lengths[in_segment]
+        load_positions.append(loads[np.searchsorted(demand_ends, segment_starts, side="right")])
+        sgen_positions.append(sgens[np.searchsorted(supply_ends, segment_starts, side="right")])
+        values.append(lengths)
+    if not values:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    return np.concatenate(load_positions), np.concatenate(sgen_positions), np.concatenate(values)
@@ -0,0 +1,178 @@
+import argparse
+import json
+import os
+from typing import Dict, Set
+
+import numpy as np
+
+from .winzent_ethics import EthicsScoreClassifier
+from .winzent_grid import GridFingerprintCache, GridTables
+from .winzent_topology import BusConnectivityIndex
+
+ARTIFACT_VERSION = 1
+AGENT_ELEMENT_TYPES = ["sgen", "load", "ext_grid", "bus"]
+
+
+def canonical_ethics_score_config(ethics_score_config) -> str:
+    """
+    returns the ethics score config as canonical json (float tier keys, sorted), so that
+    configs only differing in the type of the tiers (e.g. int keys from yaml) are equal
+    """
+    return json.dumps(
+        {
+            str(float(tier)): {agent_type: list(name_parts) for agent_type, name_parts in agent_types.items()}
+            for tier, agent_types in ethics_score_config.items()
+        },
+        sort_keys=True,
+    )
+
+
+def compile_topology(grid_json: str, ethics_score_config, path):
+    """
+    compiles a grid json and an ethics score config into a topology artifact (a
+    directory of .npy files and a meta.json) that WinzentMAS can load memory-mapped
+    instead of building the topology from the grid json. The artifact contains the
+    grid tables needed by winzent, the bus adjacency (CSR) and the ethics score and
+    agent type of every element.
+    """
+    grid = GridTables.from_json(grid_json)
+    classifier = EthicsScoreClassifier(ethics_score_config)
+    agent_types = [
+        agent_type
+        for types in ethics_score_config.values()
+        for agent_type in types.keys()
+    ]
+    os.makedirs(path, exist_ok=True)
+
+    tables = {}
+    for table, columns in GridTables.TABLE_COLUMNS.items():
+        if table not in grid:
+            continue
+        tables[table] = ["index"] + [
+            column for column in columns if column in grid[table]
+        ]
+        for column in tables[table]:
+            values = grid[table][column]
+            if values.dtype == object:
+                # fixed width strings can be memory-mapped
+                values = np.asarray(
+                    ["" if value is None else str(value) for value in values.tolist()],
+                    dtype=str,
+                )
+            np.save(os.path.join(path, f"{table}.{column}.npy"), values)
+
+    for elem_type in AGENT_ELEMENT_TYPES:
+        classified = [classifier.classify(name) for name in grid[elem_type]["name"].tolist()]
+        np.save(
+            os.path.join(path, f"{elem_type}.ethics_score.npy"),
+            np.asarray([ethics_score for ethics_score, _ in classified], dtype=np.float64),
+        )
+        np.save(
+            os.path.join(path, f"{elem_type}.agent_type.npy"),
+            np.asarray(
+                [-1 if agent_type is None else agent_types.index(agent_type)
+                 for _, agent_type in classified],
+                dtype=np.int16,
+            ),
+        )
+
+    connectivity = BusConnectivityIndex()
+    connectivity.update(grid)
+    bus_indices = grid.index("bus").tolist()
+    neighbors = [sorted(connectivity.connected_buses(bus)) for bus in bus_indices]
+    indptr = np.zeros(len(bus_indices) + 1, dtype=np.int64)
+    np.cumsum([len(buses) for buses in neighbors], out=indptr[1:])
+    np.save(os.path.join(path, "adjacency.indptr.npy"), indptr)
+    np.save(
+        os.path.join(path, "adjacency.indices.npy"),
+        np.asarray([bus for buses in neighbors for bus in buses], dtype=np.int64),
+    )
+
+    meta = {
+        "version": ARTIFACT_VERSION,
+        "tables": tables,
+        "agent_types": agent_types,
+        "ethics_score_config": canonical_ethics_score_config(ethics_score_config),
+        "content_hash": GridFingerprintCache.content_hash(grid_json).hex(),
+        "topology_hash": GridFingerprintCache.topology_hash(grid).hex(),
+    }
+    with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as file:
+        json.dump(meta, file)
+
+
+class CompiledTopology:
+    """topology artifact written by compile_topology, loaded with memory-mapped arrays"""
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as file:
+            meta = json.load(file)
+        if meta["version"] != ARTIFACT_VERSION:
+            raise ValueError(
+                f"Topology artifact {path} has version {meta['version']}, "
+                f"expected {ARTIFACT_VERSION}"
+            )
+        self.ethics_score_config = meta["ethics_score_config"]
+        self.agent_types = meta["agent_types"]
+        self.content_hash = bytes.fromhex(meta["content_hash"])
+        self.topology_hash = bytes.fromhex(meta["topology_hash"])
+
+        def load(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        self.grid = GridTables(
+            {
+                table: {column: load(f"{table}.{column}") for column in columns}
+                for table, columns in meta["tables"].items()
+            }
+        )
+        self._ethics_scores = {
+            elem_type: load(f"{elem_type}.ethics_score") for elem_type in AGENT_ELEMENT_TYPES
+        }
+        self._agent_types = {
+            elem_type: load(f"{elem_type}.agent_type") for elem_type in AGENT_ELEMENT_TYPES
+        }
+        self._indptr = load("adjacency.indptr")
+        self._indices = load("adjacency.indices")
+
+    def matches(self, ethics_score_config) -> bool:
+        """returns True if the artifact was compiled with the given ethics score config"""
+        return self.ethics_score_config == canonical_ethics_score_config(ethics_score_config)
+
+    def classify(self, elem_type, index):
+        """returns (ethics score, agent type) of the element as compiled"""
+        position = self.grid.position(elem_type, index)
+        agent_type = int(self._agent_types[elem_type][position])
+        return (
+            float(self._ethics_scores[elem_type][position]),
+            None if agent_type < 0 else self.agent_types[agent_type],
+        )
+
+    def connected_buses(self, bus_index) -> Set[int]:
+        position = self.grid.position("bus", bus_index)
+        return set(
+            self._indices[self._indptr[position]:self._indptr[position + 1]].tolist()
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compile a pandapower grid json into a winzent topology artifact"
+    )
+    parser.add_argument("grid_json", help="path of the pandapower grid json")
+    parser.add_argument(
+        "ethics_score_config", help="path of a json file with the ethics score config"
+    )
+    parser.add_argument("output", help="directory the artifact is written to")
+    args = parser.parse_args()
+    with open(args.grid_json, "r", encoding="utf-8") as file:
+        grid_json = file.read()
+    with open(args.ethics_score_config, "r", encoding="utf-8") as file:
+        # json keys are strings, the tiers are numbers
+        ethics_score_config: Dict = {
+            float(tier): agent_types for tier, agent_types in json.load(file).items()
+        }
+    compile_topology(grid_json, ethics_score_config, args.output)
+
+
+if __name__ == "__main__":
+    main()
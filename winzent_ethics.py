@@ -0,0 +1,97 @@
+import re
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+
+class EthicsScoreClassifier:
+    """
+    Compiled form of the ethics_score_config ({tier: {agent type: [name parts]}}).
+    An element name gets the tier and agent type of the first rule (in config order)
+    with a name part contained in the name. All rules are combined into one regex:
+    every rule is an alternative consisting of a lookahead for its name parts and an
+    empty marker group, so the first matching alternative is the first matching rule.
+    """
+
+    def __init__(self, ethics_score_config):
+        self.min_ethics_score = float(min(ethics_score_config.keys()))
+        # marker group number - 1 -> (tier, agent type)
+        self._rules = []
+        alternatives = []
+        for tier, agent_types in ethics_score_config.items():
+            for agent_type, name_parts in agent_types.items():
+                if not name_parts:
+                    continue
+                alternatives.append(
+                    "(?=.*?(?:"
+                    + "|".join(re.escape(name_part) for name_part in name_parts)
+                    + "))()"
+                )
+                self._rules.append((float(tier), agent_type))
+        self._pattern = re.compile(
+            "(?:" + "|".join(alternatives) + ")", re.DOTALL
+        ) if alternatives else None
+        self._memo: Dict[str, Tuple[float, Optional[str]]] = {}
+
+    def classify(self, name) -> Tuple[float, Optional[str]]:
+        """returns (ethics score, agent type) of the element name; unmatched names get the lowest tier"""
+        if name in self._memo:
+            return self._memo[name]
+        match = self._pattern.match(name) if self._pattern is not None else None
+        if match is None:
+            result = (self.min_ethics_score, None)
+        else:
+            result = self._rules[match.lastindex - 1]
+        self._memo[name] = result
+        return result
+
+
+class EthicsScoreModel:
+    """
+    Fixed-point form of the ethics score update. A score consists of its tier (integer
+    part) and a position inside the tier. Every score the update can produce is its tier
+    plus a multiple of the decay rate (sub_tier_size = 1 / steps, decay_rate =
+    sub_tier_size / steps), so scores are computed as integer ticks of the decay rate:
+    one sub tier has steps ticks and one tier steps^2 ticks.
+
+    A failed supply moves the score to the end of the next sub tier (or to the end of
+    the tier if the score is in its last tenth); a successful supply decays the score
+    by one tick, but not below the start of its current sub tier.
+    """
+
+    def __init__(self, sub_tier_size, decay_rate):
+        self.decay_rate = decay_rate
+        self.ticks_per_sub_tier = int(round(sub_tier_size / decay_rate))
+        self.ticks_per_tier = int(round(1.0 / decay_rate))
+
+    def to_ticks(self, ethics_scores) -> np.ndarray:
+        return np.rint(np.asarray(ethics_scores, dtype=np.float64) / self.decay_rate).astype(np.int64)
+
+    def from_ticks(self, ticks) -> np.ndarray:
+        tiers, positions = np.divmod(ticks, self.ticks_per_tier)
+        return tiers + positions * self.decay_rate
+
+    def update(self, ethics_scores, success) -> np.ndarray:
+        """returns the new ethics scores after a successful (success[i] == True) or failed supply"""
+        ticks = self.to_ticks(ethics_scores)
+        success = np.asarray(success, dtype=bool)
+        tier_start = ticks - ticks % self.ticks_per_tier
+        position = ticks - tier_start
+        sub_tier_start = tier_start + position - position % self.ticks_per_sub_tier
+        # success: one tick of decay, at most to the start of the sub tier
+        decayed = np.maximum(ticks - 1, sub_tier_start)
+        # failure: the score is truncated to tenths of its tier to decide if a next sub
+        # tier fits into the tier, in ticks: T - floor(10 * position / T) * T / 10 > S
+        tenths = (10 * position) // self.ticks_per_tier
+        next_sub_tier_fits = (
+                10 * self.ticks_per_tier - tenths * self.ticks_per_tier
+                > 10 * self.ticks_per_sub_tier
+        )
+        end_of_next_sub_tier = np.where(
+            position == 0,
+            tier_start + self.ticks_per_sub_tier - 1,
+            sub_tier_start + 2 * self.ticks_per_sub_tier - 1,
+        )
+        end_of_tier = tier_start + self.ticks_per_tier - 1
+        failed = np.where(next_sub_tier_fits, end_of_next_sub_tier, end_of_tier)
+        return self.from_ticks(np.where(success, decayed, failed))
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class EventLoopThread:
+    """
+    Long-lived asyncio event loop running in a daemon thread. The mango containers and
+    agents of winzent are created on this loop and stay on it for their whole lifetime,
+    so their background tasks keep running between the (synchronous) steps of palaestrAI.
+    Coroutines are submitted from other threads with run().
+    """
+
+    def __init__(self, name="winzent-event-loop"):
+        self._name = name
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run_loop():
+            asyncio.set_event_loop(self._loop)
+            self._loop.call_soon(started.set)
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run_loop, name=self._name, daemon=True)
+        self._thread.start()
+        started.wait()
+        logger.debug("%s started", self._name)
+
+    def run(self, coroutine, timeout=None):
+        """runs the coroutine on the loop and blocks until its result (or exception) is available"""
+        if not self.running:
+            self.start()
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        return future.result(timeout)
+
+    def stop(self):
+        """cancels the remaining tasks, stops the loop and joins the thread"""
+        if not self.running:
+            return
+
+        async def cancel_tasks():
+            tasks = [
+                task for task in asyncio.all_tasks() if task is not asyncio.current_task()
+            ]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(cancel_tasks(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+        self._thread = None
+        logger.debug("%s stopped", self._name)
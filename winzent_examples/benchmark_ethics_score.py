@@ -0,0 +1,33 @@
+"""Micro-benchmark of the ethics score update: one agent at a time vs. all agents at once."""
+
+import timeit
+
+import numpy as np
+
+from ..winzent_ethics import EthicsScoreModel
+
+
+def benchmark(number_of_agents=1000, number_of_steps=96, repeat=5):
+    sub_tier_size = 1.0 / number_of_steps
+    model = EthicsScoreModel(sub_tier_size, sub_tier_size / number_of_steps)
+    rng = np.random.default_rng(0)
+    ethics_scores = rng.integers(1, 4, number_of_agents).astype(np.float64)
+    success = rng.random(number_of_agents) < 0.7
+
+    def update_one_by_one():
+        return [
+            model.update([ethics_score], [agent_success]).tolist()[0]
+            for ethics_score, agent_success in zip(ethics_scores.tolist(), success.tolist())
+        ]
+
+    def update_at_once():
+        return model.update(ethics_scores, success)
+
+    assert np.allclose(update_one_by_one(), update_at_once())
+    for name, function in [("one by one", update_one_by_one), ("at once", update_at_once)]:
+        seconds = min(timeit.repeat(function, number=1, repeat=repeat))
+        print(f"{name}: {seconds * 1000:.3f} ms for {number_of_agents} agents")
+
+
+if __name__ == "__main__":
+    benchmark()
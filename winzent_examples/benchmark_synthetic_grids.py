@@ -0,0 +1,248 @@
+"""
+End-to-end benchmark of WinzentMuscle.propose_actions on synthetic grids.
+
+Every grid has a 110 kV bus with the external grid and one transformer-fed 20 kV area
+per 50 buses, in which the buses form a radial tree. Like the Bremerhaven grid, about
+half of the buses have a load and a third an sgen; the element names match the
+ETHICS_SCORE_CONFIG below. The results (step latency percentiles, messages, restarts,
+timeouts, memory) are printed as JSON, e.g.
+
+    python -m package.winzent_examples.benchmark_synthetic_grids --buses 50 500 5000 --output results.json
+"""
+
+import argparse
+import gc
+import json
+import resource
+import sys
+import time
+
+import numpy as np
+import pandapower as pp
+from palaestrai.agent import ActuatorInformation, SensorInformation
+
+from ..muscle import WinzentMuscle
+
+
+ETHICS_SCORE_CONFIG = {
+    3.0: {"hospital": ["Klinikum"], "renewable": ["PV", "Wind"]},
+    2.0: {"household": ["Households", "Abfall"]},
+    1.0: {"other": [""]},
+}
+# name part -> (share of the loads, mean p_mw)
+LOAD_KINDS = {
+    "Households": (0.75, 0.03),
+    "Industrielast": (0.15, 0.4),
+    "Abfall": (0.07, 0.2),
+    "Klinikum": (0.03, 0.8),
+}
+# name part -> share of the sgens
+SGEN_KINDS = {"PV": 0.8, "Windpark": 0.2}
+BUSES_PER_AREA = 50
+LOAD_SHARE = 0.5
+SGEN_SHARE = 0.3
+
+DEFAULT_PARAMS = {
+    "step_size": 900,
+    "end": "96*900",
+    "ttl": 80,
+    "time_to_sleep": 1,
+    "factor_mw": 1000000,
+    "number_of_restartable_negotiations": 50,
+    "send_message_paths": False,
+    "performance_logging": True,
+    "ethics_score_config": ETHICS_SCORE_CONFIG,
+}
+
+
+def generate_grid(number_of_buses, seed=0):
+    """returns a pandapower grid with number_of_buses buses (see module docstring)"""
+    rng = np.random.default_rng(seed)
+    net = pp.create_empty_network(name=f"synthetic-{number_of_buses}")
+    hv_bus = pp.create_bus(net, vn_kv=110, name="110 kV Umspannwerk")
+    pp.create_ext_grid(net, hv_bus, name="ext_grid")
+    number_of_areas = max(1, number_of_buses // BUSES_PER_AREA)
+    for area, area_size in enumerate(
+            len(buses) for buses in np.array_split(np.arange(number_of_buses - 1), number_of_areas)
+    ):
+        if area_size == 0:
+            continue
+        buses = pp.create_buses(
+            net, area_size, vn_kv=20, name=[f"20 kV Area {area}/bus_{i}" for i in range(area_size)]
+        )
+        pp.create_transformer_from_parameters(
+            net, hv_bus, buses[0], sn_mva=40, vn_hv_kv=110, vn_lv_kv=20, vkr_percent=0.3,
+            vk_percent=12, pfe_kw=14, i0_percent=0.05, name=f"Trafo Area {area}",
+        )
+        if area_size > 1:
+            # every bus hangs on one of the three buses created before it: long radial feeders
+            positions = np.arange(1, area_size)
+            parents = np.maximum(positions - rng.integers(1, 4, area_size - 1), 0)
+            pp.create_lines_from_parameters(
+                net, buses[parents], buses[positions], length_km=rng.uniform(0.1, 2, area_size - 1),
+                r_ohm_per_km=0.16, x_ohm_per_km=0.11, c_nf_per_km=260, max_i_ka=0.36,
+            )
+    mv_buses = net.bus.index[1:].to_numpy()
+    load_buses = mv_buses[rng.random(len(mv_buses)) < LOAD_SHARE]
+    load_kinds = rng.choice(
+        list(LOAD_KINDS.keys()), len(load_buses), p=[share for share, _ in LOAD_KINDS.values()]
+    )
+    pp.create_loads(
+        net, load_buses,
+        p_mw=[LOAD_KINDS[kind][1] for kind in load_kinds],
+        name=[f"{kind} - {i}" for i, kind in enumerate(load_kinds)],
+    )
+    sgen_buses = mv_buses[rng.random(len(mv_buses)) < SGEN_SHARE]
+    sgen_kinds = rng.choice(list(SGEN_KINDS.keys()), len(sgen_buses), p=list(SGEN_KINDS.values()))
+    pp.create_sgens(
+        net, sgen_buses,
+        p_mw=[2.0 if kind == "Windpark" else 0.3 for kind in sgen_kinds],
+        name=[f"{kind} - {i}" for i, kind in enumerate(sgen_kinds)],
+    )
+    return net
+
+
+class SyntheticEnvironment:
+    """
+    Sensors and actuators of a synthetic grid in the format of the palaestrAI mosaik
+    environment. The loads follow a daily profile with noise; the flexibility of the
+    sgens is scaled to supply_ratio times the mean demand.
+    """
+
+    def __init__(self, net, steps_per_day=96, supply_ratio=1.1, seed=0):
+        self._rng = np.random.default_rng(seed)
+        self.grid_json = pp.to_json(net)
+        self.steps_per_day = steps_per_day
+        self._load_ids = [
+            f"env.Powergrid-0.0-load-{index}-{bus}.p_mw"
+            for index, bus in zip(net.load.index.tolist(), net.load.bus.tolist())
+        ]
+        self._sgen_ids = [
+            f"env.Powergrid-0.0-sgen-{index}-{bus}" for index, bus in zip(net.sgen.index.tolist(), net.sgen.bus.tolist())
+        ]
+        self._load_p_mw = net.load.p_mw.to_numpy()
+        sgen_p_mw = net.sgen.p_mw.to_numpy()
+        self._sgen_p_mw = sgen_p_mw * supply_ratio * self._load_p_mw.sum() / max(sgen_p_mw.sum(), 1e-9)
+        self.actuators = [
+            ActuatorInformation(0, None, f"{sgen_id}.scaling") for sgen_id in self._sgen_ids
+        ]
+
+    def sensors(self, step):
+        """returns the grid json, the loads and the flexibility of the sgens in the step"""
+        daytime = 2 * np.pi * (step % self.steps_per_day) / self.steps_per_day
+        load_p_mw = self._load_p_mw * (0.8 - 0.3 * np.cos(daytime)) * self._rng.uniform(
+            0.7, 1.3, len(self._load_p_mw)
+        )
+        sgen_p_mw = self._sgen_p_mw * self._rng.uniform(0.5, 1.5, len(self._sgen_p_mw))
+        sensors = [SensorInformation(self.grid_json, None, "env.Powergrid-0.Grid-0.grid_json")]
+        sensors.extend(
+            SensorInformation(round(value, 6), None, sensor_id)
+            for sensor_id, value in zip(self._load_ids, load_p_mw.tolist())
+        )
+        sensors.extend(
+            SensorInformation(round(value, 6), None, f"{sgen_id}.p_mw_flex")
+            for sgen_id, value in zip(self._sgen_ids, sgen_p_mw.tolist())
+        )
+        return sensors
+
+
+def percentiles(values):
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return {}
+    return {
+        "p50": float(np.percentile(values, 50)),
+        "p90": float(np.percentile(values, 90)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(values.max()),
+        "mean": float(values.mean()),
+    }
+
+
+def max_rss_mb():
+    """peak resident memory of the process so far (kilobytes on Linux, bytes on macOS)"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def benchmark(number_of_buses, steps=8, seed=0, params=None):
+    """runs one episode of steps on a synthetic grid and returns its statistics"""
+    start_time = time.perf_counter()
+    net = generate_grid(number_of_buses, seed)
+    environment = SyntheticEnvironment(net, seed=seed)
+    muscle_params = dict(DEFAULT_PARAMS)
+    muscle_params.update(params or {})
+    muscle = WinzentMuscle("", "", "", "", "", **muscle_params)
+    setup_time = time.perf_counter() - start_time
+
+    latencies, infos = [], []
+    for step in range(steps):
+        sensors = environment.sensors(step)
+        start_time = time.perf_counter()
+        _, _, _, info = muscle.propose_actions(
+            sensors, environment.actuators, is_terminal=step == steps - 1
+        )
+        latencies.append(time.perf_counter() - start_time)
+        infos.append(info)
+
+    def values_of(key):
+        return [info.get(key, 0) for info in infos]
+
+    result = {
+        "buses": number_of_buses,
+        "loads": len(net.load),
+        "sgens": len(net.sgen),
+        "steps": steps,
+        "seed": seed,
+        "setup_seconds": setup_time,
+        # the first step also creates the agents and the topology
+        "first_step_seconds": latencies[0],
+        "step_latency": percentiles(latencies[1:] or latencies),
+        "messages_per_step": percentiles(values_of("messages")),
+        "restarts": int(sum(values_of("restarts"))),
+        "restarts_not_granted": int(sum(values_of("restarts_not_granted"))),
+        "timeouts": int(sum(values_of("timeouts"))),
+        "demand_mw": float(sum(values_of("demand"))),
+        "supply_mw": float(sum(values_of("supply"))),
+        "negotiated_mw": float(sum(values_of("negotiated"))),
+        "phase_seconds": {
+            key[len("runtime_"):]: float(sum(values_of(key)))
+            for key in sorted({key for info in infos for key in info if key.startswith("runtime_")})
+        },
+        "max_rss_mb": max_rss_mb(),
+    }
+    del muscle, environment, net
+    gc.collect()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of winzent on synthetic grids")
+    parser.add_argument("--buses", type=int, nargs="+", default=[50, 200, 1000])
+    parser.add_argument("--steps", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--params", type=json.loads, default={}, help="muscle params (json) overriding DEFAULT_PARAMS"
+    )
+    parser.add_argument("--output", default=None, help="json file for the results (default: stdout)")
+    args = parser.parse_args(argv)
+
+    results = {
+        "benchmark": "synthetic_grids",
+        "params": args.params,
+        # max_rss_mb is the peak of the process: run the sizes in ascending order
+        "results": [
+            benchmark(number_of_buses, args.steps, args.seed, args.params)
+            for number_of_buses in sorted(args.buses)
+        ],
+    }
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import hashlib
+import json
+from typing import Dict, Optional
+
+import numpy as np
+
+
+class GridTables:
+    """
+    Columnar view of the tables of a pandapower grid json that are needed by winzent.
+    Only these tables are decoded; all other tables (results, geodata, std_types, ...)
+    are skipped without building pandas objects.
+    """
+
+    # table -> columns that are read
+    TABLE_COLUMNS = {
+        "bus": ["name", "in_service"],
+        "load": ["name", "bus"],
+        "sgen": ["name", "bus"],
+        "ext_grid": ["name", "bus"],
+        "line": ["from_bus", "to_bus", "in_service"],
+        "trafo": ["hv_bus", "lv_bus", "in_service"],
+        "trafo3w": ["hv_bus", "mv_bus", "lv_bus", "in_service"],
+        "impedance": ["from_bus", "to_bus", "in_service"],
+        "switch": ["bus", "element", "et", "closed"],
+    }
+
+    def __init__(self, tables: Dict[str, Dict[str, np.ndarray]]):
+        # table -> {"index": ..., column: ...}
+        self._tables = tables
+        self._positions: Dict[str, Dict[int, int]] = {}
+
+    @classmethod
+    def from_json(cls, grid_json: str) -> "GridTables":
+        net = json.loads(grid_json)["_object"]
+        tables = {}
+        for table, columns in cls.TABLE_COLUMNS.items():
+            if table in net:
+                tables[table] = cls._read_frame(net[table], columns)
+        return cls(tables)
+
+    @staticmethod
+    def _read_frame(serialized_frame, columns):
+        """reads the given columns of a DataFrame serialized with orient "split" """
+        frame = serialized_frame["_object"]
+        if isinstance(frame, str):
+            frame = json.loads(frame)
+        dtypes = serialized_frame.get("dtype", {})
+        table = {"index": np.asarray(frame["index"], dtype=np.int64)}
+        for column in columns:
+            if column not in frame["columns"]:
+                continue
+            position = frame["columns"].index(column)
+            values = [row[position] for row in frame["data"]]
+            dtype = dtypes.get(column)
+            if dtype in ("bool", "int32", "int64", "uint32", "uint64", "float64"):
+                table[column] = np.asarray(values, dtype=dtype)
+            else:
+                # names and switch types stay python objects
+                table[column] = np.asarray(values, dtype=object)
+        return table
+
+    def __contains__(self, table):
+        return table in self._tables
+
+    def __getitem__(self, table) -> Dict[str, np.ndarray]:
+        return self._tables[table]
+
+    def index(self, table) -> np.ndarray:
+        return self._tables[table]["index"]
+
+    def position(self, table, index) -> Optional[int]:
+        """returns the row of the element with the given index (or None)"""
+        if table not in self._positions:
+            self._positions[table] = {
+                int(element_index): row
+                for row, element_index in enumerate(self._tables[table]["index"])
+            }
+        return self._positions[table].get(int(index))
+
+    def value(self, table, index, column):
+        return self._tables[table][column][self.position(table, index)]
+
+
+class GridFingerprintCache:
+    """
+    Detects unchanged grids without deserializing them with pandapower.
+    A grid is considered unchanged if either the grid json is byte-identical to the
+    last one seen or if the state relevant for the topology (element buses,
+    in_service flags and switch states) did not change.
+    """
+
+    # table -> columns that influence the winzent topology
+    TOPOLOGY_COLUMNS = {
+        "bus": ["in_service"],
+        "load": ["bus"],
+        "sgen": ["bus"],
+        "ext_grid": ["bus"],
+        "line": ["from_bus", "to_bus", "in_service"],
+        "trafo": ["hv_bus", "lv_bus", "in_service"],
+        "trafo3w": ["hv_bus", "mv_bus", "lv_bus", "in_service"],
+        "impedance": ["from_bus", "to_bus", "in_service"],
+        "switch": ["bus", "element", "et", "closed"],
+    }
+
+    def __init__(self):
+        self._content_hash: Optional[bytes] = None
+        self._topology_hash: Optional[bytes] = None
+        self.hits = 0
+
+    @staticmethod
+    def content_hash(grid_json: str) -> bytes:
+        return hashlib.blake2b(grid_json.encode("utf-8"), digest_size=16).digest()
+
+    @staticmethod
+    def topology_hash(tables: GridTables) -> bytes:
+        """hashes only the columns of the grid that define the topology"""
+        digest = hashlib.blake2b(digest_size=16)
+        for table, columns in GridFingerprintCache.TOPOLOGY_COLUMNS.items():
+            if table not in tables:
+                continue
+            digest.update(table.encode("utf-8"))
+            digest.update(tables.index(table).tobytes())
+            for column in columns:
+                values = tables[table].get(column)
+                if values is None:
+                    continue
+                if values.dtype == object:
+                    digest.update(json.dumps(values.tolist()).encode("utf-8"))
+                else:
+                    digest.update(values.tobytes())
+        return digest.digest()
+
+    def remember(self, grid_json: str, tables: GridTables):
+        """stores the fingerprint of a grid that has been applied to the topology"""
+        self.remember_hashes(self.content_hash(grid_json), self.topology_hash(tables))
+
+    def remember_hashes(self, content_hash: bytes, topology_hash: bytes):
+        self._content_hash = content_hash
+        self._topology_hash = topology_hash
+
+    def hashes(self):
+        """returns (content hash, topology hash) of the last remembered grid"""
+        return self._content_hash, self._topology_hash
+
+    def content_unchanged(self, grid_json: str) -> bool:
+        """returns True (and counts a cache hit) if grid_json equals the last grid"""
+        content_hash = self.content_hash(grid_json)
+        if content_hash == self._content_hash:
+            self.hits += 1
+            return True
+        self._content_hash = content_hash
+        return False
+
+    def topology_unchanged(self, tables: GridTables) -> bool:
+        """
+        returns True (and counts a cache hit) if the topology of the given tables equals
+        the topology of the last grid; otherwise the new fingerprint is remembered
+        """
+        topology_hash = self.topology_hash(tables)
+        if topology_hash == self._topology_hash:
+            self.hits += 1
+            return True
+        self._topology_hash = topology_hash
+        return False
@@ -1,15 +1,25 @@
-import io
+import asyncio
 import logging
+import math
 import warnings
-from typing import Optional, Dict
+from typing import Optional, Dict, Set, Tuple
 
 import matplotlib.pyplot as plt
 import networkx as nx
-import pandapower as pp
+import numpy as np
 import mango.container.factory as factory
 from mango_library.negotiation.winzent.winzent_base_agent import WinzentBaseAgent
 from mango_library.negotiation.winzent.winzent_ethical_agent import WinzentEthicalAgent
 
+from .winzent_artifact import CompiledTopology
+from .winzent_ethics import EthicsScoreClassifier
+from .winzent_grid import GridFingerprintCache, GridTables
+from .winzent_topology import (
+    BusConnectivityIndex,
+    TopologyGraph,
+    partition_by_trafos,
+)
+
 warnings.simplefilter(action="ignore", category=FutureWarning)
 logger = logging.getLogger(__name__)
 
@@ -19,16 +29,48 @@ class WinzentMAS:
     CONTAINER_ADDR = ("0.0.0.0", 5555)
 
     def __init__(
-            self, ttl, time_to_sleep, grid_json: str, send_message_paths: bool, ethics_score_config,
+            self, ttl, time_to_sleep, grid_json: Optional[str], send_message_paths: bool, ethics_score_config,
             use_ethics_score_as_negotiator,
             use_ethics_score_as_contributor,
             request_processing_waiting_time,
             reply_processing_waiting_time,
+            hierarchical=False,
+            topology_artifact=None,
     ) -> None:
         self.send_message_paths = send_message_paths
         self.ethics_score_config = ethics_score_config
         self._container = None
-        self._net = pp.from_json(io.StringIO(grid_json))
+        # hierarchical mode: one aggregator agent per transformer-fed area
+        self.hierarchical = hierarchical
+        self._area_of_bus: Dict[int, int] = {}
+        # area: sgen agents of the area
+        self._area_sgens: Dict[int, list] = {}
+        # pairs of areas connected by an in service transformer with closed switches
+        self._area_links = []
+        # area: buses the aggregator of the area is connected to
+        self._area_gateways: Dict[int, list] = {}
+        self.area_links_open = False
+        # fingerprint of the grid the topology is currently built from
+        self._grid_fingerprint = GridFingerprintCache()
+        # maintained bus adjacency, replaces pp.get_connected_buses queries
+        self._connectivity: Optional[BusConnectivityIndex] = None
+        # a compiled topology (see winzent_artifact) replaces reading the grid json
+        self._topology_artifact: Optional[CompiledTopology] = None
+        if topology_artifact is not None:
+            self._topology_artifact = CompiledTopology(topology_artifact)
+            self._grid = self._topology_artifact.grid
+            self._grid_fingerprint.remember_hashes(
+                self._topology_artifact.content_hash,
+                self._topology_artifact.topology_hash,
+            )
+        else:
+            # only the tables needed by winzent are read from the grid json
+            self._grid = GridTables.from_json(grid_json)
+            self._grid_fingerprint.remember(grid_json, self._grid)
+            self._connectivity = BusConnectivityIndex()
+            self._connectivity.update(self._grid)
+        # (elem_type, index): bus indices the agent is currently connected to
+        self._connected_buses: Dict[Tuple[str, int], Set[int]] = {}
         # all winzent agents as dictionary (e.g. self.winzent_agents["bus"][34] returns bus with index 35)
         self.winzent_agents = {
             elem_type: {} for elem_type in WinzentMAS.ELEMENT_TYPES_WITH_AGENTS
@@ -37,8 +79,16 @@ class WinzentMAS:
         self.time_to_sleep = time_to_sleep
         # agent_id: winzent_agent
         self.aid_agent_mapping: Dict[str, WinzentBaseAgent] = {}
-        self.graph = nx.DiGraph()
+        # grid, fingerprint and agent state of the first step, restored by reset_episode
+        self._base_grid = self._grid
+        self._base_grid_hashes = self._grid_fingerprint.hashes()
+        self._initial_ethics_scores: Dict[str, float] = {}
+        self.graph = TopologyGraph()
         self.agent_types = {}
+        # aid -> agent type, the reverse of agent_types
+        self.agent_type_of: Dict[str, str] = {}
+        # assigns ethics score and agent type by element name
+        self._ethics_classifier = EthicsScoreClassifier(ethics_score_config)
         self.index_zero_counter = 0
         self.use_ethics_score_as_negotiator = use_ethics_score_as_negotiator
         self.use_ethics_score_as_contributor = use_ethics_score_as_contributor
@@ -50,80 +100,309 @@ class WinzentMAS:
         self._container = await factory.create(
             addr=WinzentMAS.CONTAINER_ADDR
         )
+        if self.hierarchical:
+            self._area_of_bus = partition_by_trafos(self._grid)
+        # the compiled classification is only valid for the config it was compiled with
+        use_compiled_classification = self._topology_artifact is not None
+        if use_compiled_classification and not self._topology_artifact.matches(self.ethics_score_config):
+            logger.warning(
+                "The topology artifact was compiled with a different ethics score config, "
+                "the elements are classified again"
+            )
+            use_compiled_classification = False
         for elem_type in WinzentMAS.ELEMENT_TYPES_WITH_AGENTS:
-            for index in self._net[elem_type].index:
-                winzent_agent = self._create_agent(elem_type, index)
-                self.winzent_agents[elem_type][index] = winzent_agent
-                self.aid_agent_mapping[winzent_agent.aid] = winzent_agent
-                self.graph.add_node(winzent_agent.aid)
-                logger.debug(f"initial score:{winzent_agent.ethics_score}")
+            for index in self._grid.index(elem_type).tolist():
+                name = self._grid.value(elem_type, index, "name")
+                if use_compiled_classification:
+                    ethics_score, agent_type = self._topology_artifact.classify(elem_type, index)
+                else:
+                    ethics_score, agent_type = self._ethics_classifier.classify(name)
+                winzent_agent = self._register_agent(elem_type, index, ethics_score)
+                if agent_type is not None:
+                    self.agent_types[agent_type].append(winzent_agent.aid)
+                    self.agent_type_of[winzent_agent.aid] = agent_type
+                logger.debug(
+                    "%s (%s) is %s with ethics score %s", winzent_agent.aid, name, agent_type, ethics_score
+                )
+        if self.hierarchical:
+            self._create_area_agents()
+
+    def _register_agent(self, elem_type, index, ethics_score):
+        winzent_agent = self._create_agent(elem_type, index, self._container, ethics_score)
+        self.winzent_agents[elem_type][index] = winzent_agent
+        self.aid_agent_mapping[winzent_agent.aid] = winzent_agent
+        self._initial_ethics_scores[winzent_agent.aid] = ethics_score
+        self.graph.add_node(winzent_agent.aid)
+        logger.debug("initial score:%s", winzent_agent.ethics_score)
+        return winzent_agent
+
+    def _create_area_agents(self):
+        """
+        creates one aggregator agent (elem_type "area") per transformer-fed area.
+        Aggregators are connected to the transformer buses of their area and, while
+        the area links are open, to the aggregators of neighboring areas.
+        """
+        self.winzent_agents["area"] = {}
+        buses_of_area = {}
+        for bus_index, area in self._area_of_bus.items():
+            buses_of_area.setdefault(area, []).append(bus_index)
+        for area, bus_indices in buses_of_area.items():
+            self._register_agent("area", area, self._ethics_classifier.min_ethics_score)
+            self._area_sgens[area] = []
+        for agent in self.winzent_agents["sgen"].values():
+            bus_index = int(self._grid.value("sgen", agent.index, "bus"))
+            self._area_sgens[self._area_of_bus[bus_index]].append(agent)
+
+        trafo_buses = {area: set() for area in buses_of_area}
+        trafos = self._grid["trafo"]
+        for hv_bus, lv_bus in zip(trafos["hv_bus"].tolist(), trafos["lv_bus"].tolist()):
+            trafo_buses[self._area_of_bus[hv_bus]].add(hv_bus)
+            trafo_buses[self._area_of_bus[lv_bus]].add(lv_bus)
+        for area, bus_indices in buses_of_area.items():
+            # areas without a transformer are represented by their first bus
+            self._area_gateways[area] = sorted(trafo_buses[area]) or [min(bus_indices)]
+        self._update_area_links()
+
+    def _update_area_links(self):
+        """
+        derives the links between the aggregators from the current connectivity of the
+        buses: two areas are linked while a branch between them (a transformer, since
+        lines separate no areas) is in service and not opened by a switch
+        """
+        area_links = set()
+        for bus_index, area in self._area_of_bus.items():
+            for connected_bus_index in self._connected_bus_indices(bus_index):
+                connected_area = self._area_of_bus.get(connected_bus_index)
+                if (
+                        connected_area is not None
+                        and connected_area != area
+                        # out of service buses still list their branches
+                        and bus_index in self._connected_bus_indices(connected_bus_index)
+                ):
+                    area_links.add((min(area, connected_area), max(area, connected_area)))
+        if sorted(area_links) == self._area_links:
+            return
+        links_open = self.area_links_open
+        if links_open:
+            self.close_area_links()
+        self._area_links = sorted(area_links)
+        if links_open:
+            self.open_area_links()
+        logger.debug("%s links between the areas", len(self._area_links))
 
     def build_topology(self):
         for elem_type in WinzentMAS.ELEMENT_TYPES_WITH_AGENTS:
             for index, agent in self.winzent_agents[elem_type].items():
                 connected_bus_indices = self._get_connected_buses(
-                    self._net, elem_type, index
+                    self._grid, elem_type, index
                 )
+                self._connected_buses[(elem_type, index)] = connected_bus_indices
                 for bus_index in connected_bus_indices:
                     bus_agent = self.get_agent("bus", bus_index)
                     if bus_agent is None:
                         logger.critical("Could not create topology")
                     self._add_neighbors(agent, bus_agent)
+        if self.hierarchical:
+            for area, bus_indices in self._area_gateways.items():
+                for bus_index in bus_indices:
+                    self._add_neighbors(
+                        self.winzent_agents["area"][area], self.get_agent("bus", bus_index)
+                    )
+
+    def open_area_links(self):
+        """connects the aggregators of areas that are connected by a transformer"""
+        for area_1, area_2 in self._area_links:
+            self._add_neighbors(
+                self.winzent_agents["area"][area_1], self.winzent_agents["area"][area_2]
+            )
+        self.area_links_open = True
+
+    def close_area_links(self):
+        """isolates the areas again so that negotiations resolve locally"""
+        for area_1, area_2 in self._area_links:
+            self._delete_neighbors(
+                self.winzent_agents["area"][area_1], self.winzent_agents["area"][area_2]
+            )
+        self.area_links_open = False
+
+    def escalate_to_areas(self, t_start, remaining_flexibility):
+        """
+        hands the remaining flexibility of the sgens (agent id -> value) to the
+        aggregator of their area, which answers for it while the area links are open
+        """
+        for area, sgen_agents in self._area_sgens.items():
+            area_flexibility = 0
+            for sgen_agent in sgen_agents:
+                area_flexibility += max(remaining_flexibility.get(sgen_agent.aid, 0), 0)
+                sgen_agent.update_flexibility(t_start=t_start, min_p=0, max_p=0)
+            self.winzent_agents["area"][area].update_flexibility(
+                t_start=t_start, min_p=0, max_p=math.floor(area_flexibility)
+            )
+        self.open_area_links()
+
+    def distribute_area_results(self, solution, remaining_flexibility):
+        """
+        replaces the values negotiated with aggregators in the solution (agent id -> value)
+        by values for the sgens of the area, proportional to their remaining flexibility
+        """
+        distributed = {}
+        for aid, value in solution.items():
+            agent = self.aid_agent_mapping.get(aid)
+            if agent is None or agent.elem_type != "area":
+                distributed[aid] = distributed.get(aid, 0) + value
+                continue
+            sgen_agents = [
+                sgen_agent for sgen_agent in self._area_sgens[agent.index]
+                if remaining_flexibility.get(sgen_agent.aid, 0) > 0
+            ]
+            area_flexibility = sum(
+                remaining_flexibility[sgen_agent.aid] for sgen_agent in sgen_agents
+            )
+            if not sgen_agents:
+                logger.error("%s negotiated %s without remaining flexibility in its area", aid, value)
+                continue
+            # shares of the aggregator's value per sgen
+            shares = {}
+            remaining_value = value
+            for sgen_agent in sgen_agents:
+                shares[sgen_agent.aid] = min(
+                    math.floor(value * remaining_flexibility[sgen_agent.aid] / area_flexibility),
+                    remaining_value,
+                )
+                remaining_value -= shares[sgen_agent.aid]
+            # rounding leftovers go to the sgens with free flexibility
+            for sgen_agent in sgen_agents:
+                if remaining_value <= 0:
+                    break
+                free = remaining_flexibility[sgen_agent.aid] - shares[sgen_agent.aid]
+                extra = min(max(math.floor(free), 0), remaining_value)
+                shares[sgen_agent.aid] += extra
+                remaining_value -= extra
+            for sgen_aid, share in shares.items():
+                distributed[sgen_aid] = distributed.get(sgen_aid, 0) + share
+        return distributed
 
     def set_agent_types(self):
         type_list = []
         for value_list in self.ethics_score_config.values():
             type_list.extend(list(value_list.keys()))
         self.agent_types = {key: [] for key in type_list}
+        self.agent_type_of = {}
+
+    def reset_episode(self):
+        """
+        prepares the agents for a new episode without recreating them: the topology of
+        the first step is restored and results, flexibilities, sent message counters
+        and ethics scores are reset
+        """
+        if self.area_links_open:
+            self.close_area_links()
+        if self._grid is not self._base_grid:
+            self._apply_grid(self._base_grid)
+        if self.hierarchical:
+            self._update_area_links()
+        self._grid_fingerprint.remember_hashes(*self._base_grid_hashes)
+        for agent in self.aid_agent_mapping.values():
+            agent.result = {}
+            agent.final = {}
+            agent.messages_sent = 0
+            agent.ethics_score = self._initial_ethics_scores[agent.aid]
+            for flexibility in ("flex", "original_flex"):
+                if isinstance(getattr(agent, flexibility, None), dict):
+                    getattr(agent, flexibility).clear()
 
     async def shutdown(self):
-        for elem_type in WinzentMAS.ELEMENT_TYPES_WITH_AGENTS:
-            for agent in self.winzent_agents[elem_type].values():
-                await agent.stop_agent()
-                await agent.shutdown()
+        await asyncio.gather(
+            *(self._shutdown_agent(agent) for agent in self.aid_agent_mapping.values())
+        )
         await self._container.shutdown()
 
+    @staticmethod
+    async def _shutdown_agent(agent):
+        await agent.stop_agent()
+        await agent.shutdown()
+
     def get_agent(self, elem_type, index) -> Optional[WinzentBaseAgent]:
         if elem_type in self.winzent_agents:
             if index in self.winzent_agents[elem_type]:
                 return self.winzent_agents[elem_type][index]
         return None
 
-    def _create_agent(self, elem_type, index):
+    def get_bus_agent_of(self, agent) -> Optional[WinzentBaseAgent]:
+        """returns the agent of the bus the element (load, sgen, ext_grid) is currently connected to"""
+        for bus_index in self._connected_buses.get((agent.elem_type, agent.index), ()):
+            return self.get_agent("bus", bus_index)
+        return None
+
+    def _create_agent(self, elem_type, index, container, ethics_score):
         if not self.use_ethics_score_as_negotiator and not self.use_ethics_score_as_contributor:
             return WinzentBaseAgent(
-                container=self._container,
+                container=container,
                 elem_type=elem_type,
                 index=index,
                 ttl=self.ttl,
                 time_to_sleep=self.time_to_sleep,
                 send_message_paths=self.send_message_paths,
-                ethics_score=self._assign_ethics_score(self._net[elem_type].at[index, "name"], index),)
+                ethics_score=ethics_score,)
         else:
             return WinzentEthicalAgent(
-                container=self._container,
+                container=container,
                 elem_type=elem_type,
                 index=index,
                 ttl=self.ttl,
                 time_to_sleep=self.time_to_sleep,
                 send_message_paths=self.send_message_paths,
-                ethics_score=self._assign_ethics_score(self._net[elem_type].at[index, "name"], index),
+                ethics_score=ethics_score,
                 use_ethics_score_as_negotiator =self.use_ethics_score_as_negotiator,
                 use_ethics_score_as_contributor=self.use_ethics_score_as_contributor,
                 request_processing_waiting_time=self.request_processing_waiting_time,
                 reply_processing_waiting_time=self.reply_processing_waiting_time,
             )
 
-    def _get_connected_buses(self, net, elem_type, index):
+    def _connected_bus_indices(self, bus_index) -> Set[int]:
+        """returns the buses connected to the bus in the latest applied grid"""
+        # the connectivity index always reflects the latest applied grid
+        if self._connectivity is not None:
+            return self._connectivity.connected_buses(bus_index)
+        return self._topology_artifact.connected_buses(bus_index)
+
+    def _get_connected_buses(self, grid, elem_type, index):
         if elem_type == "bus":
-            return pp.get_connected_buses(
-                net,
-                buses=index,
-                respect_switches=True,
-                respect_in_service=True,
-            )
+            connected_bus_indices = self._connected_bus_indices(index)
+            if self.hierarchical:
+                # areas are only connected through their aggregators
+                return {
+                    bus_index for bus_index in connected_bus_indices
+                    if self._area_of_bus.get(bus_index) == self._area_of_bus.get(index)
+                }
+            return connected_bus_indices
         else:
-            return {net[elem_type].at[index, "bus"]}
+            return {int(grid.value(elem_type, index, "bus"))}
+
+    def _get_agents_with_changed_connections(self, new_grid):
+        """returns (elem_type, index) of all agents whose connected buses may have changed"""
+        changed = [
+            ("bus", bus_index)
+            for bus_index in self._connectivity.update(new_grid)
+            if bus_index in self.winzent_agents["bus"]
+        ]
+        for elem_type in WinzentMAS.ELEMENT_TYPES_WITH_AGENTS:
+            if elem_type == "bus":
+                continue
+            old_elements = self._grid[elem_type]
+            new_elements = new_grid[elem_type]
+            if np.array_equal(old_elements["index"], new_elements["index"]):
+                changed_indices = old_elements["index"][
+                    old_elements["bus"] != new_elements["bus"]
+                ].tolist()
+            else:
+                changed_indices = self.winzent_agents[elem_type].keys()
+            changed.extend(
+                (elem_type, index)
+                for index in changed_indices
+                if index in self.winzent_agents[elem_type]
+            )
+        return changed
 
     def _add_neighbors(self, agent_1, agent_2):
         # winzent's add neighbor method adds or replaces the agent (no duplicates in neighborhood)
@@ -132,37 +411,64 @@ class WinzentMAS:
         self.graph.add_edge(agent_1.aid, agent_2.aid)
 
     def save_plot(self, filename):
-        labels = {aid: aid[5:] for aid in self.graph.nodes}
+        graph = self.graph.to_networkx()
+        labels = {aid: aid[5:] for aid in graph.nodes}
         plt.title("WinzentMAS topology (labels are agent ids)")
-        nx.draw(self.graph, node_size=100, font_size=7, labels=labels)
+        nx.draw(graph, node_size=100, font_size=7, labels=labels)
         plt.savefig(filename)
 
     def _delete_neighbors(self, agent_1, agent_2):
         agent_1.delete_neighbor(aid=agent_2.aid)
         agent_2.delete_neighbor(aid=agent_1.aid)
+        self.graph.remove_edge(agent_1.aid, agent_2.aid)
+
+    @property
+    def topology_cache_hits(self) -> int:
+        """number of topology updates that were skipped because the grid did not change"""
+        return self._grid_fingerprint.hits
 
     def check_changes_and_update_topolgy(self, grid_json: str):
-        new_net = pp.from_json(io.StringIO(grid_json))
-        for elem_type in WinzentMAS.ELEMENT_TYPES_WITH_AGENTS:
-            for index, agent in self.winzent_agents[elem_type].items():
-                connected_bus_indices = self._get_connected_buses(
-                    new_net, elem_type, index
-                )
-                old_connected_bus_indices = self._get_connected_buses(
-                    self._net, elem_type, index
-                )
+        if self._grid_fingerprint.content_unchanged(grid_json):
+            logger.debug("Grid json unchanged, skipping topology update")
+            return
+        new_grid = GridTables.from_json(grid_json)
+        if self._grid_fingerprint.topology_unchanged(new_grid):
+            logger.debug("Grid topology unchanged, skipping topology update")
+            return
+        self._apply_grid(new_grid)
 
-                disconnected_bus_indices = (
-                    old_connected_bus_indices.difference(connected_bus_indices)
-                )
-                new_connected_bus_indices = connected_bus_indices.difference(
-                    old_connected_bus_indices
-                )
-                self.update_neighborhoods(
-                    agent, disconnected_bus_indices, new_connected_bus_indices
-                )
+    def _apply_grid(self, new_grid: GridTables):
+        """rewires the agents whose connected buses differ between the current and the new grid"""
+        if self._connectivity is None:
+            # started from a compiled topology, the index is only needed once the grid changes
+            self._connectivity = BusConnectivityIndex()
+            self._connectivity.update(self._grid)
+        # only agents touched by a changed branch, bus or element are compared
+        for elem_type, index in self._get_agents_with_changed_connections(new_grid):
+            agent = self.winzent_agents[elem_type][index]
+            connected_bus_indices = self._get_connected_buses(
+                new_grid, elem_type, index
+            )
+            old_connected_bus_indices = self._connected_buses.get(
+                (elem_type, index), set()
+            )
+            if connected_bus_indices == old_connected_bus_indices:
+                continue
 
-        self._net = new_net
+            disconnected_bus_indices = (
+                old_connected_bus_indices.difference(connected_bus_indices)
+            )
+            new_connected_bus_indices = connected_bus_indices.difference(
+                old_connected_bus_indices
+            )
+            self.update_neighborhoods(
+                agent, disconnected_bus_indices, new_connected_bus_indices
+            )
+            self._connected_buses[(elem_type, index)] = connected_bus_indices
+
+        self._grid = new_grid
+        if self.hierarchical:
+            self._update_area_links()
 
     def update_neighborhoods(
             self, agent, disconnected_bus_indices, new_connected_bus_indices
@@ -178,25 +484,3 @@ class WinzentMAS:
             if bus_agent is None:
                 logger.critical("Could not create topology")
             self._add_neighbors(agent, bus_agent)
-
-    def _assign_ethics_score(self, name, index):
-        print(f"agent{index} is {name}")
-        self._add_agent_types(name, index)
-        ethics_values = list(self.ethics_score_config.keys())
-        print(ethics_values)
-        for value in ethics_values:
-            for index in range(len(self.ethics_score_config[value].values())):
-                if any(string in name for string in list(self.ethics_score_config[value].values())[index]):
-                    print(f"agent{index}, {name} gets ethics score {value}")
-                    return float(value)
-        print(f"Could not find agent{index}, {name} gets min ethics score {value}")
-        return min(ethics_values)
-
-
-    def _add_agent_types(self, name, index):
-        for ethics_score in self.ethics_score_config.keys():
-            for type in self.ethics_score_config[ethics_score]:
-                for agent_name in self.ethics_score_config[ethics_score][type]:
-                    if agent_name in name:
-                        self.agent_types[type].append("agent" + str(index))
-                        return
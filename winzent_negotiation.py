@@ -0,0 +1,310 @@
+import asyncio
+import heapq
+import itertools
+import math
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+
+class NegotiationTracker:
+    """
+    Keeps track of the running negotiations of a step. wait() returns as soon as at least
+    one negotiation is done or has timed out, so every negotiation is handled the moment
+    it finishes. Every negotiation has its own timeout and all of them are bounded by
+    one deadline for the whole step. Finished negotiations are reported by a done
+    callback of their future and the deadlines are kept in a heap, so handling a
+    negotiation does not depend on the number of running negotiations.
+    """
+
+    def __init__(self, step_timeout):
+        self._loop = asyncio.get_event_loop()
+        self.step_deadline = self._loop.time() + step_timeout
+        # token -> (agent, start of the negotiation, deadline of the negotiation)
+        self._running: Dict[int, Tuple[object, float, float]] = {}
+        self._tokens = itertools.count()
+        # (deadline, token), entries of negotiations that are no longer running are skipped
+        self._deadlines: List[Tuple[float, int]] = []
+        # tokens of the negotiations that finished since the last wait()
+        self._finished: Deque[int] = deque()
+        # resolved by the first finished negotiation while wait() is waiting
+        self._waiter: Optional[asyncio.Future] = None
+        # aid -> duration of the last finished or timed out negotiation of the agent
+        self.latencies: Dict[str, float] = {}
+
+    def __len__(self):
+        return len(self._running)
+
+    @property
+    def expired(self) -> bool:
+        """True once the deadline of the step has passed"""
+        return self._loop.time() >= self.step_deadline
+
+    def add(self, agent, timeout):
+        """tracks the negotiation the agent has just started"""
+        future = asyncio.ensure_future(agent.negotiation_done)
+        now = self._loop.time()
+        token = next(self._tokens)
+        deadline = min(now + timeout, self.step_deadline)
+        self._running[token] = (agent, now, deadline)
+        heapq.heappush(self._deadlines, (deadline, token))
+        future.add_done_callback(lambda _, token=token: self._on_done(token))
+
+    def _on_done(self, token):
+        if token not in self._running:
+            # the negotiation has already timed out
+            return
+        self._finished.append(token)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _next_deadline(self) -> float:
+        while self._deadlines[0][1] not in self._running:
+            heapq.heappop(self._deadlines)
+        return self._deadlines[0][0]
+
+    async def wait(self) -> Tuple[List, List]:
+        """returns (agents with finished negotiations, agents with timed out negotiations)"""
+        if not self._running:
+            return [], []
+        timeout = self._next_deadline() - self._loop.time()
+        if not self._finished and timeout > 0:
+            self._waiter = self._loop.create_future()
+            timer = self._loop.call_later(
+                timeout, lambda waiter=self._waiter: waiter.done() or waiter.set_result(None)
+            )
+            try:
+                await self._waiter
+            finally:
+                timer.cancel()
+                self._waiter = None
+        now = self._loop.time()
+        finished = []
+        while self._finished:
+            token = self._finished.popleft()
+            if token in self._running:
+                finished.append(self._pop(token, now))
+        timed_out = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, token = heapq.heappop(self._deadlines)
+            if token in self._running:
+                timed_out.append(self._pop(token, now))
+        return finished, timed_out
+
+    def _pop(self, token, now):
+        agent, start, _ = self._running.pop(token)
+        self.latencies[agent.aid] = now - start
+        return agent
+
+
+class LatencySketch:
+    """
+    Streaming quantile sketch of negotiation latencies with a relative accuracy
+    (log-spaced buckets as in DDSketch). Memory only grows with the log of the range
+    of the observed latencies, not with their number.
+    """
+
+    def __init__(self, relative_accuracy=0.02, min_latency=1e-3):
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._min_latency = min_latency
+        # bucket -> count, bucket i holds latencies in (gamma^(i-1), gamma^i]
+        self._buckets: Dict[int, int] = {}
+        self._zero_count = 0
+        self.count = 0
+
+    def add(self, latency):
+        self.count += 1
+        if latency <= self._min_latency:
+            self._zero_count += 1
+            return
+        bucket = math.ceil(math.log(latency) / self._log_gamma)
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+
+    def quantile(self, q) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self._zero_count
+        if rank < seen:
+            return self._min_latency
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if rank < seen:
+                # center of the bucket
+                return 2 * self._gamma ** bucket / (self._gamma + 1)
+        return 2 * self._gamma ** max(self._buckets) / (self._gamma + 1)
+
+
+class RestartScheduler:
+    """
+    Hands out the restarts of unsuccessful negotiations of a step. Restart requests are
+    queued by priority: loads of higher ethics tiers first and, within a tier, the
+    smallest remaining deficit first (it is the most likely one to be covered). A restart
+    is only granted while the global, per-agent and per-tier budgets allow it and fewer
+    than max_concurrent restarts are running. A load whose last restart did not reduce
+    its deficit is not restarted again, as the same negotiation would fail again.
+    """
+
+    def __init__(
+            self,
+            total_budget,
+            per_agent_budget=None,
+            per_tier_budget: Optional[Dict[float, int]] = None,
+            max_concurrent=None,
+    ):
+        self.total_budget = total_budget
+        self.per_agent_budget = per_agent_budget
+        self.per_tier_budget = dict(per_tier_budget or {})
+        self.max_concurrent = max_concurrent
+        self._queue = []
+        self._counter = itertools.count()
+        self._restarts_of_agent: Dict[str, int] = {}
+        # aid -> deficit when the agent was restarted the last time
+        self._last_deficit: Dict[str, int] = {}
+        self._running = set()
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def request(self, agent, deficit) -> bool:
+        """
+        queues a restart of the agent for its remaining deficit. Returns False if the
+        agent can not get a restart (budget exhausted or no progress since its last
+        restart); the negotiation of the agent is then final.
+        """
+        self._running.discard(agent.aid)
+        tier = float(math.floor(agent.ethics_score))
+        if (
+                self.total_budget <= 0
+                or (self.per_agent_budget is not None
+                    and self._restarts_of_agent.get(agent.aid, 0) >= self.per_agent_budget)
+                or self.per_tier_budget.get(tier, 1) <= 0
+                or self._last_deficit.get(agent.aid, math.inf) <= deficit
+        ):
+            self.skipped += 1
+            return False
+        heapq.heappush(self._queue, (-tier, deficit, next(self._counter), agent))
+        return True
+
+    def finished(self, agent):
+        """marks a (restarted) negotiation of the agent as done"""
+        self._running.discard(agent.aid)
+
+    def next_restarts(self, feasible=None) -> Tuple[List[Tuple[object, int]], List]:
+        """
+        pops the restarts that may be started now as (agent, deficit). Restarts for which
+        feasible(agent, deficit) is False are dropped without using the budget.
+        Returns (restarts, agents with dropped restarts).
+        """
+        restarts = []
+        dropped = []
+        while self._queue and (
+                self.max_concurrent is None or len(self._running) < self.max_concurrent
+        ):
+            minus_tier, deficit, _, agent = heapq.heappop(self._queue)
+            tier = -minus_tier
+            if feasible is not None and not feasible(agent, deficit):
+                dropped.append(agent)
+                continue
+            # budgets may have been used up since the request was queued
+            if self.total_budget <= 0 or self.per_tier_budget.get(tier, 1) <= 0:
+                self.skipped += 1
+                continue
+            self.total_budget -= 1
+            if tier in self.per_tier_budget:
+                self.per_tier_budget[tier] -= 1
+            self._restarts_of_agent[agent.aid] = self._restarts_of_agent.get(agent.aid, 0) + 1
+            self._last_deficit[agent.aid] = deficit
+            self._running.add(agent.aid)
+            restarts.append((agent, deficit))
+        return restarts, dropped
+
+    def drain(self) -> List:
+        """removes and returns the agents that are still waiting for a restart"""
+        agents = [agent for _, _, _, agent in self._queue]
+        self._queue = []
+        return agents
+
+
+class FlexibilityLedger:
+    """
+    Live account of the flexibility of a step: the flexibility offered by the sgens
+    and the values committed to the negotiating agents so far, per connected component
+    of the topology (agents without a component share one account). Negotiations can
+    only be covered by the unallocated flexibility of their component.
+    """
+
+    def __init__(self, flexibility: Dict[str, int], component_of=None):
+        self._component_of = component_of if component_of is not None else (lambda aid: None)
+        self._available: Dict[Optional[int], int] = {}
+        for aid, value in flexibility.items():
+            component = self._component_of(aid)
+            self._available[component] = self._available.get(component, 0) + value
+        self._committed_by_component: Dict[Optional[int], int] = {}
+        # aid -> value committed to the agent
+        self._committed: Dict[str, int] = {}
+
+    @property
+    def available(self) -> int:
+        return sum(self._available.values())
+
+    @property
+    def committed(self) -> int:
+        return sum(self._committed.values())
+
+    def update(self, agent):
+        """books the current result of the negotiating agent"""
+        committed = sum(agent.result.values())
+        component = self._component_of(agent.aid)
+        self._committed_by_component[component] = (
+            self._committed_by_component.get(component, 0)
+            + committed - self._committed.get(agent.aid, 0)
+        )
+        self._committed[agent.aid] = committed
+
+    def unallocated(self, agent) -> int:
+        """flexibility that is still available to the agent"""
+        component = self._component_of(agent.aid)
+        return self._available.get(component, 0) - self._committed_by_component.get(component, 0)
+
+
+def split_result(result: Dict[str, int], demands: List[int], rule="proportional", priorities=None) -> List[Dict[str, int]]:
+    """
+    splits the result of a negotiation for the merged demand of several loads
+    (sgen aid -> negotiated value) back into one result per load.
+    rule "proportional": every load gets the same share of its demand
+    rule "ethics_score": loads are supplied completely in the order of their priorities
+    (highest first), as long as the negotiated value suffices
+    """
+    total = min(sum(result.values()), sum(demands))
+    if rule == "proportional":
+        demand_sum = sum(demands)
+        exact = [total * demand / demand_sum if demand_sum > 0 else 0 for demand in demands]
+        amounts = [math.floor(value) for value in exact]
+        # largest remainder, so the amounts add up to the negotiated value
+        by_remainder = sorted(range(len(demands)), key=lambda i: exact[i] - amounts[i], reverse=True)
+        for i in by_remainder[:total - sum(amounts)]:
+            amounts[i] += 1
+    elif rule == "ethics_score":
+        amounts = [0] * len(demands)
+        remaining = total
+        for i in sorted(range(len(demands)), key=lambda i: priorities[i], reverse=True):
+            amounts[i] = min(demands[i], remaining)
+            remaining -= amounts[i]
+    else:
+        raise ValueError(f"Unknown rule to split a negotiation result: {rule}")
+
+    # hand out the values of the sgens to the loads one after another
+    results = [{} for _ in demands]
+    contributions = [[sgen, value] for sgen, value in result.items() if value > 0]
+    for load_result, amount in zip(results, amounts):
+        while amount > 0:
+            contribution = contributions[0]
+            value = min(contribution[1], amount)
+            load_result[contribution[0]] = load_result.get(contribution[0], 0) + value
+            amount -= value
+            contribution[1] -= value
+            if contribution[1] == 0:
+                contributions.pop(0)
+    return results
@@ -0,0 +1,88 @@
+import logging
+import os
+from typing import Dict, List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EthicsScoreRecorder:
+    """
+    Records the development of the ethics scores of an episode in preallocated arrays
+    (one row per step, one column per agent): the ethics score after the step, whether
+    the agent was supplied, its tier and its deficit. Agents without a final
+    negotiation in a step keep the empty values (score nan, success -1). flush() writes
+    the episode as one compressed NPZ file.
+    """
+
+    def __init__(self, number_of_steps, number_of_agents=64):
+        self._capacity = (max(int(number_of_steps), 1), max(int(number_of_agents), 1))
+        # aid -> column
+        self._columns: Dict[str, int] = {}
+        self._times: List[int] = []
+        self._allocate()
+
+    def _allocate(self):
+        shape = self._capacity
+        self.ethics_score = np.full(shape, np.nan, dtype=np.float64)
+        self.success = np.full(shape, -1, dtype=np.int8)
+        self.tier = np.full(shape, -1, dtype=np.int16)
+        self.deficit = np.zeros(shape, dtype=np.int64)
+
+    def _grow(self, rows, columns):
+        old = (self.ethics_score, self.success, self.tier, self.deficit)
+        self._capacity = (
+            max(self._capacity[0], rows),
+            max(self._capacity[1], columns),
+        )
+        self._allocate()
+        for new_array, old_array in zip(
+                (self.ethics_score, self.success, self.tier, self.deficit), old
+        ):
+            new_array[:old_array.shape[0], :old_array.shape[1]] = old_array
+
+    def __len__(self):
+        return len(self._times)
+
+    def record(self, time, aids, ethics_scores, success, deficits):
+        """records the outcomes of the agents in the step starting at time"""
+        if not self._times or self._times[-1] != time:
+            self._times.append(time)
+        row = len(self._times) - 1
+        for aid in aids:
+            if aid not in self._columns:
+                self._columns[aid] = len(self._columns)
+        if row >= self._capacity[0] or len(self._columns) > self._capacity[1]:
+            self._grow(2 * (row + 1), 2 * len(self._columns))
+        columns = np.fromiter(
+            (self._columns[aid] for aid in aids), dtype=np.int64, count=len(aids)
+        )
+        ethics_scores = np.asarray(ethics_scores, dtype=np.float64)
+        self.ethics_score[row, columns] = ethics_scores
+        self.success[row, columns] = np.asarray(success, dtype=np.int8)
+        self.tier[row, columns] = np.floor(ethics_scores).astype(np.int16)
+        self.deficit[row, columns] = np.asarray(deficits, dtype=np.int64)
+
+    def flush(self, path, episode):
+        """writes the recorded steps to path/ethics_scores_episode_<episode>.npz and clears the recorder"""
+        rows = len(self._times)
+        columns = len(self._columns)
+        if rows > 0:
+            os.makedirs(path, exist_ok=True)
+            filename = os.path.join(path, f"ethics_scores_episode_{episode}.npz")
+            np.savez_compressed(
+                filename,
+                time=np.asarray(self._times, dtype=np.int64),
+                aid=np.asarray(list(self._columns.keys()), dtype=str),
+                ethics_score=self.ethics_score[:rows, :columns],
+                success=self.success[:rows, :columns],
+                tier=self.tier[:rows, :columns],
+                deficit=self.deficit[:rows, :columns],
+            )
+            logger.info(f"Saved the ethics scores of {rows} steps to {filename}")
+        self.clear()
+
+    def clear(self):
+        self._times = []
+        self._allocate()
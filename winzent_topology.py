@@ -0,0 +1,389 @@
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+class BusConnectivityIndex:
+    """
+    Maintained bus adjacency of a grid. connected_buses(bus) returns the same buses as
+    pp.get_connected_buses(net, bus, respect_switches=True, respect_in_service=True),
+    but after the initial build, update() only processes branches (lines, trafos,
+    trafo3ws, impedances and bus-bus switches) whose state changed.
+    """
+
+    BRANCH_COLUMNS = {
+        "bus": ["in_service"],
+        "line": ["from_bus", "to_bus", "in_service"],
+        "trafo": ["hv_bus", "lv_bus", "in_service"],
+        "trafo3w": ["hv_bus", "mv_bus", "lv_bus", "in_service"],
+        "impedance": ["from_bus", "to_bus", "in_service"],
+        "switch": ["bus", "element", "et", "closed"],
+    }
+
+    def __init__(self):
+        self._tables = {}
+        # table -> {element index: row position}
+        self._positions: Dict[str, Dict[int, int]] = {}
+        # (table, element index) -> bus pairs the branch currently connects
+        self._branches: Dict[Tuple[str, int], Tuple[Tuple[int, int], ...]] = {}
+        # bus -> Counter(neighbor bus -> number of active branches between them)
+        self._edge_count = defaultdict(Counter)
+        self._out_of_service_buses: Set[int] = set()
+        # switch type -> elements (lines, trafos) or buses (trafo3w) opened by switches
+        self._opened = {"l": set(), "t": set(), "t3": set()}
+
+    def connected_buses(self, bus) -> Set[int]:
+        return {
+            neighbor
+            for neighbor, count in self._edge_count[bus].items()
+            if count > 0
+            and neighbor != bus
+            and neighbor not in self._out_of_service_buses
+        }
+
+    def update(self, tables) -> Set[int]:
+        """
+        applies the state of the given tables (GridTables or table -> {"index": ...,
+        column: ...}) to the index and returns the buses whose connected buses may have changed
+        """
+        dirty_rows = {
+            table: self._changed_rows(table, tables[table])
+            for table in self.BRANCH_COLUMNS
+            if table in tables
+        }
+        previous_switches = self._tables.get("switch")
+        self._tables.update(
+            {table: tables[table] for table in dirty_rows}
+        )
+        for table in dirty_rows:
+            self._positions[table] = {
+                int(index): position
+                for position, index in enumerate(tables[table]["index"])
+            }
+
+        dirty_branches = set()
+        for table in ("line", "trafo", "trafo3w", "impedance"):
+            dirty_branches.update(
+                (table, index) for index in dirty_rows.get(table, ())
+            )
+        if dirty_rows.get("switch"):
+            dirty_branches |= self._branches_of_switches(
+                previous_switches, dirty_rows["switch"]
+            )
+            self._update_opened()
+
+        touched_buses = set()
+        for key in dirty_branches:
+            touched_buses |= self._apply_branch(key)
+        for bus in dirty_rows.get("bus", ()):
+            touched_buses |= self._apply_bus(bus)
+        return touched_buses
+
+    def _changed_rows(self, table, new):
+        """returns the indices of rows that were added, removed or modified"""
+        old = self._tables.get(table)
+        if old is None or not np.array_equal(old["index"], new["index"]):
+            old_indices = set() if old is None else set(old["index"].tolist())
+            return old_indices | set(new["index"].tolist())
+        changed = np.zeros(len(new["index"]), dtype=bool)
+        for column in self.BRANCH_COLUMNS[table]:
+            changed |= old[column] != new[column]
+        return set(new["index"][changed].tolist())
+
+    def _branches_of_switches(self, previous_switches, switch_indices):
+        """returns all branches affected by the old or new state of the given switches"""
+        branches = set()
+        switch_states = [self._tables["switch"]]
+        if previous_switches is not None:
+            switch_states.append(previous_switches)
+        for switches in switch_states:
+            positions = {
+                int(index): position
+                for position, index in enumerate(switches["index"])
+            }
+            for index in switch_indices:
+                if index not in positions:
+                    continue
+                position = positions[index]
+                et = switches["et"][position]
+                element = int(switches["element"][position])
+                if et == "b":
+                    branches.add(("switch", index))
+                elif et == "l":
+                    branches.add(("line", element))
+                elif et == "t":
+                    branches.add(("trafo", element))
+                elif et == "t3":
+                    branches.update(
+                        ("trafo3w", int(trafo))
+                        for trafo in self._tables.get("trafo3w", {}).get("index", ())
+                    )
+        return branches
+
+    def _update_opened(self):
+        switches = self._tables["switch"]
+        opened = {"l": set(), "t": set(), "t3": set()}
+        for et, bus, element, closed in zip(
+                switches["et"], switches["bus"], switches["element"], switches["closed"]
+        ):
+            if closed or et not in opened:
+                continue
+            opened[et].add(int(bus) if et == "t3" else int(element))
+        self._opened = opened
+
+    def _branch_pairs(self, table, index):
+        """returns the bus pairs the branch connects in the current state"""
+        position = self._positions.get(table, {}).get(index)
+        if position is None:
+            return ()
+        rows = self._tables[table]
+        if table == "switch":
+            if rows["et"][position] != "b" or not rows["closed"][position]:
+                return ()
+            return ((int(rows["bus"][position]), int(rows["element"][position])),)
+        if not rows["in_service"][position]:
+            return ()
+        if table == "line" or table == "impedance":
+            if table == "line" and index in self._opened["l"]:
+                return ()
+            return ((int(rows["from_bus"][position]), int(rows["to_bus"][position])),)
+        if table == "trafo":
+            if index in self._opened["t"]:
+                return ()
+            return ((int(rows["hv_bus"][position]), int(rows["lv_bus"][position])),)
+        # trafo3w: every pair of windings whose buses are not opened by a switch
+        buses = [
+            int(rows[column][position])
+            for column in ("hv_bus", "mv_bus", "lv_bus")
+            if int(rows[column][position]) not in self._opened["t3"]
+        ]
+        return tuple(
+            (buses[i], buses[j])
+            for i in range(len(buses))
+            for j in range(i + 1, len(buses))
+        )
+
+    def _apply_branch(self, key):
+        old_pairs = self._branches.get(key, ())
+        new_pairs = self._branch_pairs(*key)
+        if old_pairs == new_pairs:
+            return set()
+        touched_buses = set()
+        for bus_1, bus_2 in old_pairs:
+            self._edge_count[bus_1][bus_2] -= 1
+            self._edge_count[bus_2][bus_1] -= 1
+            touched_buses.update((bus_1, bus_2))
+        for bus_1, bus_2 in new_pairs:
+            self._edge_count[bus_1][bus_2] += 1
+            self._edge_count[bus_2][bus_1] += 1
+            touched_buses.update((bus_1, bus_2))
+        if new_pairs:
+            self._branches[key] = new_pairs
+        else:
+            self._branches.pop(key, None)
+        return touched_buses
+
+    def _apply_bus(self, bus):
+        position = self._positions["bus"].get(bus)
+        in_service = position is not None and bool(
+            self._tables["bus"]["in_service"][position]
+        )
+        if in_service:
+            self._out_of_service_buses.discard(bus)
+        else:
+            self._out_of_service_buses.add(bus)
+        # the in_service state of a bus changes the connected buses of its neighbors
+        touched_buses = {bus}
+        touched_buses.update(
+            neighbor
+            for neighbor, count in self._edge_count[bus].items()
+            if count > 0
+        )
+        return touched_buses
+
+
+class TopologyGraph:
+    """
+    Undirected agent topology stored as adjacency arrays indexed by dense integer ids.
+    Every node has its own neighbor array that holds the ids of its neighbors in the
+    first degree[i] entries and doubles its capacity when it is full, so the memory
+    grows with the number of edges. Neighbor lookups are array slices and edges are
+    removed by swapping in the last neighbor. Use to_networkx() or csr() to export the graph.
+    """
+
+    def __init__(self, node_capacity=64, degree_capacity=4):
+        # agent id -> dense id and dense id -> agent id
+        self._ids: Dict[str, int] = {}
+        self._aids = []
+        self._degree_capacity = degree_capacity
+        # dense id -> neighbor array of the node
+        self._neighbors: List[np.ndarray] = []
+        self._degree = np.zeros(node_capacity, dtype=np.int32)
+        # component label of every dense id, computed on demand
+        self._components: Optional[np.ndarray] = None
+
+    def __len__(self):
+        return len(self._aids)
+
+    def __contains__(self, aid):
+        return aid in self._ids
+
+    @property
+    def nodes(self):
+        return list(self._aids)
+
+    def number_of_edges(self) -> int:
+        return int(self._degree[:len(self._aids)].sum()) // 2
+
+    def node_id(self, aid) -> int:
+        return self._ids[aid]
+
+    def add_node(self, aid) -> int:
+        if aid in self._ids:
+            return self._ids[aid]
+        node = len(self._aids)
+        if node == len(self._degree):
+            self._degree = np.concatenate(
+                (self._degree, np.zeros_like(self._degree))
+            )
+        self._ids[aid] = node
+        self._aids.append(aid)
+        self._neighbors.append(np.full(self._degree_capacity, -1, dtype=np.int32))
+        self._components = None
+        return node
+
+    def neighbor_ids(self, node) -> np.ndarray:
+        return self._neighbors[node][:self._degree[node]]
+
+    def neighbors(self, aid):
+        return [self._aids[node] for node in self.neighbor_ids(self._ids[aid])]
+
+    def has_edge(self, aid_1, aid_2) -> bool:
+        if aid_1 not in self._ids or aid_2 not in self._ids:
+            return False
+        return bool(
+            (self.neighbor_ids(self._ids[aid_1]) == self._ids[aid_2]).any()
+        )
+
+    def add_edge(self, aid_1, aid_2):
+        # agents are never their own neighbors, so self loops are not stored
+        if aid_1 == aid_2 or self.has_edge(aid_1, aid_2):
+            return
+        node_1 = self.add_node(aid_1)
+        node_2 = self.add_node(aid_2)
+        self._append_neighbor(node_1, node_2)
+        self._append_neighbor(node_2, node_1)
+        self._components = None
+
+    def remove_edge(self, aid_1, aid_2):
+        if not self.has_edge(aid_1, aid_2):
+            return
+        node_1 = self._ids[aid_1]
+        node_2 = self._ids[aid_2]
+        self._remove_neighbor(node_1, node_2)
+        self._remove_neighbor(node_2, node_1)
+        self._components = None
+
+    def _append_neighbor(self, node, neighbor):
+        degree = self._degree[node]
+        neighbors = self._neighbors[node]
+        if degree == len(neighbors):
+            neighbors = np.concatenate((neighbors, np.full_like(neighbors, -1)))
+            self._neighbors[node] = neighbors
+        neighbors[degree] = neighbor
+        self._degree[node] = degree + 1
+
+    def _remove_neighbor(self, node, neighbor):
+        neighbors = self._neighbors[node]
+        last = self._degree[node] - 1
+        position = int(np.flatnonzero(self.neighbor_ids(node) == neighbor)[0])
+        neighbors[position] = neighbors[last]
+        neighbors[last] = -1
+        self._degree[node] = last
+
+    def component_of(self, aid) -> Optional[int]:
+        """returns the label of the connected component of the agent (None if it is not in the graph)"""
+        if aid not in self._ids:
+            return None
+        if self._components is None:
+            self._components = self._label_components()
+        return int(self._components[self._ids[aid]])
+
+    def _label_components(self) -> np.ndarray:
+        indptr, indices = self.csr()
+        number_of_nodes = len(self._aids)
+        adjacency = csr_matrix(
+            (np.ones(len(indices), dtype=np.int8), indices, indptr),
+            shape=(number_of_nodes, number_of_nodes),
+        )
+        _, labels = connected_components(adjacency, directed=False)
+        return labels
+
+    def csr(self):
+        """returns the adjacency as CSR arrays (indptr, indices) over the dense ids"""
+        degree = self._degree[:len(self._aids)]
+        indptr = np.zeros(len(degree) + 1, dtype=np.int64)
+        np.cumsum(degree, out=indptr[1:])
+        if len(degree) == 0:
+            return indptr, np.zeros(0, dtype=np.int32)
+        return indptr, np.concatenate(
+            [neighbors[:node_degree] for neighbors, node_degree in zip(self._neighbors, degree.tolist())]
+        )
+
+    def to_networkx(self):
+        import networkx as nx
+
+        graph = nx.Graph()
+        graph.add_nodes_from(self._aids)
+        indptr, indices = self.csr()
+        for node, aid in enumerate(self._aids):
+            graph.add_edges_from(
+                (aid, self._aids[neighbor])
+                for neighbor in indices[indptr[node]:indptr[node + 1]]
+                if neighbor > node
+            )
+        return graph
+
+
+def partition_by_trafos(grid) -> Dict[int, int]:
+    """
+    assigns every bus of the grid to an area (bus index -> area id). Buses connected
+    by lines, impedances or bus-bus switches belong to the same area, transformers
+    separate areas, so every area is fed by a substation. The partition is based on
+    the grid structure only and ignores in_service flags and switch states.
+    """
+    parent = {int(bus): int(bus) for bus in grid.index("bus")}
+
+    def find(bus):
+        while parent[bus] != bus:
+            parent[bus] = parent[parent[bus]]
+            bus = parent[bus]
+        return bus
+
+    def union(bus_1, bus_2):
+        root_1, root_2 = find(int(bus_1)), find(int(bus_2))
+        if root_1 != root_2:
+            parent[max(root_1, root_2)] = min(root_1, root_2)
+
+    for table in ("line", "impedance"):
+        if table in grid:
+            for from_bus, to_bus in zip(grid[table]["from_bus"], grid[table]["to_bus"]):
+                union(from_bus, to_bus)
+    if "switch" in grid:
+        switches = grid["switch"]
+        for bus, element, et in zip(switches["bus"], switches["element"], switches["et"]):
+            if et == "b":
+                union(bus, element)
+
+    area_ids = {}
+    areas = {}
+    for bus in sorted(parent):
+        root = find(bus)
+        if root not in area_ids:
+            area_ids[root] = len(area_ids)
+        areas[bus] = area_ids[root]
+    return areas
+
@@ -1,5 +1,6 @@
 from typing import Tuple, Optional, List
 
+import numpy as np
 from palaestrai.agent import SensorInformation
 
 
@@ -56,3 +57,63 @@ class WinzentSensorActuatorUtil:
         id_parts = sensor_or_actuator_id.split(".")
         sensor_or_actuator_type = id_parts[3]
         return sensor_or_actuator_type
+
+
+class SensorActuatorIndex:
+    """
+    Positions of the sensors and actuators winzent works with, compiled once from the
+    sensor and actuator mapping (lists of (type, agent)), so that the values of a step
+    can be gathered in one pass and processed as arrays.
+    """
+
+    def __init__(
+        self,
+        sensor_mapping: List[Tuple[str, Optional[object]]],
+        actuator_mapping: List[Tuple[str, Optional[object]]],
+        sensor_ids: List[str],
+    ):
+        def positions(mapping, mapping_type, elem_type=None):
+            return np.asarray(
+                [
+                    position
+                    for position, (sensor_or_actuator_type, agent) in enumerate(mapping)
+                    if sensor_or_actuator_type == mapping_type
+                    and agent is not None
+                    and (elem_type is None or agent.elem_type == elem_type)
+                ],
+                dtype=np.int64,
+            )
+
+        self.sgen_flex_positions = positions(sensor_mapping, "p_mw_flex", "sgen")
+        self.sgen_flex_agents = [sensor_mapping[i][1] for i in self.sgen_flex_positions]
+        self.load_positions = positions(sensor_mapping, "p_mw", "load")
+        self.load_agents = [sensor_mapping[i][1] for i in self.load_positions]
+        self.scaling_positions = positions(actuator_mapping, "scaling")
+        self.scaling_agents = [actuator_mapping[i][1] for i in self.scaling_positions]
+        # all sensors of loads (p_mw and q_mvar), for logging the needed load
+        self.load_sensor_positions = np.asarray(
+            [
+                position
+                for position, sensor_id in enumerate(sensor_ids)
+                if "load" in sensor_id
+            ],
+            dtype=np.int64,
+        )
+        self._gather_positions = np.concatenate(
+            (self.sgen_flex_positions, self.load_positions, self.load_sensor_positions)
+        ).tolist()
+        self._splits = np.cumsum(
+            [len(self.sgen_flex_positions), len(self.load_positions)]
+        )
+
+    def gather(
+        self, sensors: List[SensorInformation]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """returns the values of (sgen flexibility, load p_mw, all load sensors)"""
+        values = np.fromiter(
+            (sensors[position].sensor_value for position in self._gather_positions),
+            dtype=np.float64,
+            count=len(self._gather_positions),
+        )
+        sgen_flex, load_p_mw, load_sensors = np.split(values, self._splits)
+        return sgen_flex, load_p_mw, load_sensors